@@ -0,0 +1,63 @@
+import contextlib
+import time
+from unittest import mock
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from a_cart.models import Cart
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+class WriteCounter:
+    # counts write statements through connection.execute_wrapper, which (unlike connection.queries) isn't capped
+    def __init__(self):
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+            self.writes += 1
+        return execute(sql, params, many, context)
+
+get_lazily = Cart.get_from_request
+
+def get_or_create_eagerly(request):
+    # the behavior before carts were lazy: every visitor got a session and a cart on their first page view
+    if not request.session.session_key:
+        request.session.create()
+    return get_lazily(request).materialize(request)
+
+class Command(BaseCommand):
+    help = "Count the database writes of anonymous catalog views, with eager and lazy cart creation (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--views', type=int, default=10000, help="The number of anonymous visitors, who each view the product list once")
+
+    def handle(self, *args, **options):
+        views = options['views']
+        self.stdout.write(f"{'carts':<8} {'writes':>8} {'per 10k views':>14} {'carts created':>14} {'seconds':>8}")
+        for label, patch in (
+            ('eager', mock.patch.object(Cart, 'get_from_request', get_or_create_eagerly)),
+            ('lazy', contextlib.nullcontext()),
+        ):
+            with patch:
+                writes, carts, elapsed = self.measure(views)
+            self.stdout.write(f"{label:<8} {writes:>8} {writes * 10000 / views:>14.0f} {carts:>14} {elapsed:>8.1f}")
+
+    def measure(self, views):
+        with transaction.atomic(), override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            carts_before = Cart.objects.count()
+            start = time.perf_counter()
+            counter = WriteCounter()
+            with connection.execute_wrapper(counter):
+                for _ in range(views):
+                    # a new visitor without cookies, whose browser also loads the navbar menus
+                    client = Client()
+                    client.get(reverse('products:home'))
+                    client.get(reverse('cart:navbar_menus'))
+            elapsed = time.perf_counter() - start
+            carts = Cart.objects.count() - carts_before
+            transaction.set_rollback(True)
+        return counter.writes, carts, elapsed
@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from a_cart.models import Cart
+from a_products.models import Product
+
+def add_by_read_modify_write(cart, product, quantity=1):
+    # how Cart.add_product worked before its upsert: concurrent adds can read the same quantity and overwrite each other
+    cart_item, created = cart.items.get_or_create(product=product, defaults={'quantity': quantity})
+    if not created:
+        cart_item.quantity += quantity
+        cart_item.save()
+
+def add_by_bulk_upsert(cart, product, quantity=1):
+    # the path of merging carts on login and of moving cookie carts into the database
+    cart.add_quantities({product.pk: quantity})
+
+ADD_FUNCTIONS = {
+    'upsert': Cart.add_product,
+    'bulk-upsert': add_by_bulk_upsert,
+    'read-modify-write': add_by_read_modify_write,
+}
+
+def add_repeatedly(mode, cart_id, product_id, adds):
+    """
+    Add the product to the cart one at a time, from a worker process.
+
+    :return: A tuple (adds that succeeded, adds that failed)
+    """
+    cart = Cart.objects.get(pk=cart_id)
+    product = Product.objects.get(pk=product_id)
+    succeeded = failed = 0
+    for _ in range(adds):
+        try:
+            ADD_FUNCTIONS[mode](cart, product)
+            succeeded += 1
+        except OperationalError:
+            # e.g. 'database is locked', when a write waited longer than the database's timeout
+            failed += 1
+    connections.close_all()
+    return succeeded, failed
+
+class Command(BaseCommand):
+    help = "Add one product to one cart from many processes at once, and check the cart for lost increments and duplicate items"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+        parser.add_argument('--adds', type=int, default=200, help="The number of adds per process")
+        parser.add_argument('--mode', choices=list(ADD_FUNCTIONS), action='append', help="Defaults to all modes")
+
+    def handle(self, *args, **options):
+        product = Product.objects.order_by('pk').first()
+        if product is None:
+            raise CommandError("There are no products to add")
+
+        self.stdout.write(f"{'mode':<18} {'adds':>7} {'quantity':>9} {'lost':>6} {'items':>6} {'failed':>7} {'adds/s':>8}")
+        for mode in options['mode'] or ADD_FUNCTIONS:
+            # a throwaway cart, as the processes can't share a transaction to roll back
+            cart = Cart.objects.create()
+            try:
+                succeeded, failed, elapsed = self.stress(mode, cart, product, options['processes'], options['adds'])
+                items = list(cart.items.all())
+                quantity = sum(item.quantity for item in items)
+            finally:
+                cart.delete()
+            self.stdout.write(
+                f"{mode:<18} {succeeded:>7} {quantity:>9} {succeeded - quantity:>6} {len(items):>6} {failed:>7} {succeeded / elapsed:>8.0f}"
+            )
+
+    def stress(self, mode, cart, product, processes, adds):
+        # fork (this command has no other threads) without an open connection, so each process opens its own
+        connections.close_all()
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork')) as executor:
+            # start the processes before timing them
+            list(executor.map(time.sleep, [0.1] * processes))
+            start = time.perf_counter()
+            results = list(executor.map(add_repeatedly, *zip(*[(mode, cart.pk, product.pk, adds)] * processes)))
+            elapsed = time.perf_counter() - start
+        return sum(result[0] for result in results), sum(result[1] for result in results), elapsed
@@ -0,0 +1,20 @@
+from django.utils.functional import SimpleLazyObject
+from .storage import get_cart, save_cookie_cart
+
+class CartMiddleware:
+    """
+    Set `request.cart` to the visitor's cart (see a_cart.storage.get_cart), resolved lazily.
+
+    The cart (with its items and their products) is fetched the first time it's used, and at
+    most once per request, so requests that never touch it don't query it at all. A changed
+    cookie cart is written to its cookie on the way out.
+    Must come after AuthenticationMiddleware, as the cart depends on `request.user`.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.cart = SimpleLazyObject(lambda: get_cart(request))
+        response = self.get_response(request)
+        save_cookie_cart(request, response)
+        return response
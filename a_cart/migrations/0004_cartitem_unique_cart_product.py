@@ -0,0 +1,29 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:26
+
+from django.db import migrations, models
+
+
+def merge_duplicate_items(apps, schema_editor):
+    CartItem = apps.get_model('a_cart', 'CartItem')
+    duplicates = CartItem.objects.values('cart', 'product').annotate(count=models.Count('id')).filter(count__gt=1)
+    for duplicate in list(duplicates):
+        # keep the first item, with the total quantity of all of them
+        items = list(CartItem.objects.filter(cart=duplicate['cart'], product=duplicate['product']).order_by('added_at', 'id'))
+        items[0].quantity = sum(item.quantity for item in items)
+        items[0].save(update_fields=['quantity'])
+        CartItem.objects.filter(pk__in=[item.pk for item in items[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_cart', '0003_remove_cart_unique_user_session_cart_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_product'),
+        ),
+    ]
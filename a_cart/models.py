@@ -1,15 +1,44 @@
-from django.db import models, transaction
+from decimal import Decimal
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Prefetch, Sum
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from a_products.models import Product
 from django.urls import reverse
+from django.utils import timezone
 import uuid
 
+# the relations rendered with each cart item
+CART_ITEM_RELATED = ('product', 'product__primary_image', 'product__secondary_image')
+
+class CartSummary:
+    """
+    The totals of a cart (see Cart.get_summary).
+    """
+    def __init__(self, num_items=0, num_lines=0, total_price=Decimal('0.00')):
+        self.num_items = num_items  # the sum of the quantities
+        self.num_lines = num_lines  # the number of distinct products
+        self.total_price = total_price
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Sum up cart items that are already loaded.
+        """
+        return cls(
+            num_items=sum(item.quantity for item in items),
+            num_lines=len(items),
+            total_price=sum((item.get_total_price() for item in items), Decimal('0.00')),
+        )
+
 # Create your models here.
 class Cart(models.Model):
     user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    _summary = None  # memoized by get_summary
+
     # ensure that each authenticated user can only have one cart, while still allowing multiple carts without users (for anonymous users)
     class Meta:
         constraints = [
@@ -21,86 +50,201 @@ class Cart(models.Model):
         ]
 
     @classmethod
-    def get_or_create_from_request(cls, request):
+    def get_from_request(cls, request):
         """
-        Get an existing cart or create a new one for the given request.
+        Get the cart for the given request, without writing to the database.
 
-        This method ensures that every request has an associated cart, whether the user
-        is authenticated or not. It prioritizes finding existing carts for authenticated users.
+        Visitors who never added anything have no cart (nor session) in the database. They get
+        an unsaved cart instead, which reads as empty until `materialize` saves it. The items
+        and their products are prefetched along with the cart.
+
+        Views should use `request.cart` (see a_cart.middleware), which calls this at most once per request.
 
         Args:
             cls: The Cart class (passed implicitly as this is a class method).
             request: The HTTP request object.
 
         Returns:
-            A tuple (Cart, bool) where the boolean indicates whether a new cart was created.
+            The visitor's cart; unsaved (without a pk) if they don't have one yet.
         """
-        # Ensure the session exists
-        if not request.session.session_key:
-            request.session.create()
+        # For authenticated users, return their existing cart
+        carts = cls.objects.prefetch_related(Prefetch('items', queryset=CartItem.objects.select_related(*CART_ITEM_RELATED)))
+        if request.user.is_authenticated:
+            cart = carts.filter(user=request.user).first() or cls()
+            cart.user = request.user  # already loaded; spares a query when the cart's user is read
+            return cart
 
-        with transaction.atomic():
-            # For authenticated users, return their existing cart or create a new one
-            if request.user.is_authenticated:
-                try:
-                    cart = cls.objects.get(user=request.user)
-                    created = False
-                except cls.DoesNotExist:
-                    cart = cls.objects.create(user=request.user)
-                    created = True
-            # For anonymous users, get cart by session key or create a new cart
+        # For anonymous users, get the cart by the id in their session (reading an empty session doesn't create it)
+        cart_id = request.session.get('cart_id')
+        cart = carts.filter(id=cart_id, user__isnull=True).first() if cart_id else None
+        return cart or cls()
+
+    def materialize(self, request):
+        """
+        Save the cart if it's unsaved, and remember it in the session.
+
+        This is what creates the cart and the session of a visitor, so it should only be called
+        when the cart gets its first item (or is otherwise needed in the database).
+
+        Args:
+            request: The HTTP request object.
+
+        Returns:
+            The saved cart: this cart, or the user's cart if a concurrent request created it first.
+        """
+        cart = self
+        if cart.pk is None:
+            if cart.user_id is not None:
+                # at most one cart per user (see Meta.constraints)
+                cart, created = Cart.objects.get_or_create(user_id=cart.user_id)
             else:
-                cart_id = request.session.get('cart_id')
-                if cart_id:
-                    try:
-                        cart = cls.objects.get(id=cart_id, user__isnull=True)
-                        created = False
-                    except cls.DoesNotExist:
-                        cart = cls.objects.create()
-                        created = True
-                else:
-                    cart = cls.objects.create()
-                    created = True
+                cart.save()
 
         # Update the session with the cart ID
-        session_cart_id = request.session.get('cart_id')
-        if not session_cart_id or session_cart_id != cart.id:
+        if request.session.get('cart_id') != cart.id:
             request.session['cart_id'] = cart.id
-            request.session.modified = True
+        return cart
 
-        return cart, created
+    def for_update(self, request):
+        """
+        Get the cart ready for adding products: saved, as its items are rows referring to it.
+
+        Anonymous carts kept in a cookie (see a_cart.storage.CookieCart) are changed as they are.
+        """
+        return self.materialize(request)
+
+    @classmethod
+    def get_or_create_from_request(cls, request):
+        """
+        Get an existing cart or create a new one for the given request.
+
+        Only use this where the cart must exist in the database (e.g. to add a product to
+        it); otherwise `get_from_request` avoids creating carts for visitors who browse only.
+
+        Returns:
+            A tuple (Cart, bool) where the boolean indicates whether a new cart was created.
+        """
+        cart = cls.get_from_request(request)
+        created = cart.pk is None
+        return cart.materialize(request), created
 
     def __str__(self):
         return f"{self.user}'s cart {self.id}" if self.user else f"Anonymous cart {self.id}"
 
+    def get_items(self):
+        """
+        Get the items of the cart, with their products and product images joined in.
+        """
+        # an unsaved cart (see get_from_request) has no items, and no related manager yet
+        if self.pk is None:
+            return CartItem.objects.none()
+        if self.has_prefetched_items():
+            return self.items.all()
+        return self.items.select_related(*CART_ITEM_RELATED)
+
+    def has_prefetched_items(self):
+        return 'items' in getattr(self, '_prefetched_objects_cache', {})
+
+    def forget_items(self):
+        # called after changing the items, which makes the summary and any prefetched items stale
+        self._summary = None
+        getattr(self, '_prefetched_objects_cache', {}).pop('items', None)
+
+    def get_summary(self):
+        """
+        Get the totals of the cart, computed with (at most) one aggregate query.
+
+        The summary is memoized on the cart instance, so the views, navbar and cotton
+        components rendering the same cart share it; the cart's mutating methods clear it.
+        A cart with prefetched items (see get_from_request) is summed up from those, without a query.
+
+        Returns:
+            A CartSummary.
+        """
+        if self._summary is None:
+            if self.pk is None:
+                self._summary = CartSummary()
+            elif self.has_prefetched_items():
+                self._summary = CartSummary.from_items(self.get_items())
+            else:
+                self._summary = CartSummary(**self.items.aggregate(
+                    num_items=Coalesce(Sum('quantity'), 0),
+                    num_lines=Count('id'),
+                    total_price=Coalesce(
+                        Sum(F('quantity') * F('product__price'), output_field=models.DecimalField(max_digits=12, decimal_places=2)),
+                        Decimal('0.00'),
+                    ),
+                ))
+        return self._summary
+
     def get_total_price(self):
-        return sum(item.get_total_price() for item in self.items.all())
+        return self.get_summary().total_price
 
     def get_num_items(self):
-        return sum(item.quantity for item in self.items.all())
+        return self.get_summary().num_items
 
     def get_absolute_url(self):
         return reverse("view_cart")
 
     def add_product(self, product, quantity=1):
-        cart_item, created = self.items.get_or_create(product=product, defaults={'quantity': quantity})
-        if not created:
-            cart_item.quantity += quantity
-            cart_item.save()
+        """
+        Add a quantity of a product to the cart, with one atomic upsert.
+
+        The item is inserted, or, if the cart already has the product (see CartItem.Meta.constraints),
+        its quantity is incremented by the database, so concurrent adds (e.g. quick clicks) neither
+        lose an increment nor duplicate the item.
+
+        Returns:
+            The cart item, with its new quantity.
+        """
+        cart_item = CartItem.objects.raw(UPSERT_CART_ITEM_SQL, [self.pk, product.pk, quantity, connection.ops.adapt_datetimefield_value(timezone.now())])[0]
+        cart_item.cart, cart_item.product = self, product
+        self.forget_items()
         return cart_item
 
+    def add_quantities(self, quantities):
+        """
+        Add several products to the cart at once, with one bulk upsert (per UPSERT_BATCH_SIZE products).
+
+        Args:
+            quantities: A dictionary of the quantities to add, by product id.
+        """
+        if not quantities:
+            return
+        # like add_product, the database adds to existing quantities, so concurrent adds aren't lost
+        added_at = connection.ops.adapt_datetimefield_value(timezone.now())
+        rows = [(self.pk, product_id, quantity, added_at) for product_id, quantity in quantities.items()]
+        with transaction.atomic(), connection.cursor() as cursor:
+            for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+                batch = rows[start:start + UPSERT_BATCH_SIZE]
+                cursor.execute(get_upsert_cart_items_sql(len(batch)), [value for row in batch for value in row])
+        self.forget_items()
+
     def merge_with(self, other_cart):
-        for item in other_cart.items.all():
-            self.add_product(item.product, item.quantity)
+        """
+        Move the items of another cart into this one, and delete the other cart.
+
+        The quantities of products in both carts are added up. This takes a fixed number of
+        queries, however many items the carts have: the other cart's items are read once, and
+        added to this cart's quantities with one bulk upsert, all in one transaction.
+        """
+        with transaction.atomic():
+            self.add_quantities(dict(other_cart.items.values_list('product_id', 'quantity')))
+            other_cart.delete()
+
+    def get_item(self, product_id):
+        return self.get_items().get(product_id=product_id)
 
     def update_quantity(self, product_id, quantity):
-        cart_item = self.items.get(product_id=product_id)
+        cart_item = self.get_item(product_id)
         cart_item.quantity = quantity
         cart_item.save()
+        self.forget_items()
 
     def remove_product(self, product_id):
-        cart_item = self.items.get(product_id=product_id)
+        cart_item = self.get_item(product_id)
         cart_item.delete()
+        self.forget_items()
     
 
 class CartItem(models.Model):
@@ -109,8 +253,29 @@ class CartItem(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     added_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+
     def __str__(self):
         return f"{self.quantity} of {self.product.name} in {self.cart}"
 
     def get_total_price(self):
-        return self.product.price * self.quantity
\ No newline at end of file
+        return self.product.price * self.quantity
+
+# insert a cart item or add to its quantity, in one statement (see Cart.add_product)
+UPSERT_CART_ITEM_SQL = f"""
+    INSERT INTO {CartItem._meta.db_table} (cart_id, product_id, quantity, added_at) VALUES (%s, %s, %s, %s)
+    ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {CartItem._meta.db_table}.quantity + excluded.quantity
+    RETURNING *
+"""
+
+# the same for several cart items (see Cart.add_quantities); 4 parameters per row stays below SQLite's limit of 999
+UPSERT_BATCH_SIZE = 200
+
+def get_upsert_cart_items_sql(num_rows):
+    return f"""
+        INSERT INTO {CartItem._meta.db_table} (cart_id, product_id, quantity, added_at) VALUES {', '.join(['(%s, %s, %s, %s)'] * num_rows)}
+        ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {CartItem._meta.db_table}.quantity + excluded.quantity
+    """
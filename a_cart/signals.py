@@ -1,7 +1,9 @@
 from allauth.account.signals import user_logged_in
 from django.dispatch import receiver
 from django.db import transaction
+from django.conf import settings
 from .models import Cart
+from .storage import CookieCart
 import logging
 
 logger = logging.getLogger(__name__)
@@ -27,9 +29,8 @@ def transfer_cart(user, session):
                 # a cart from the anonymous session should not have a user associated with it; in which case we can merge it into the user's cart
                 if session_cart.user is None:
                     # If session cart exists but isn't associated with a user,
-                    # merge it into the user's cart and delete the session cart
+                    # merge it into the user's cart (which deletes the session cart)
                     user_cart.merge_with(session_cart)
-                    session_cart.delete()
                     logger.info(f"Merged anonymous cart {session_cart_id} into user's cart {user_cart.id}")
                 elif session_cart.user != user:
                     # If session cart belongs to a different user (shouldn't normally happen),
@@ -47,4 +48,7 @@ def transfer_cart(user, session):
 
 @receiver(user_logged_in)
 def transfer_cart_to_authenticated_user(sender, request, user, **kwargs):
-    transfer_cart(user, request.session)
\ No newline at end of file
+    user_cart = transfer_cart(user, request.session)
+    if settings.CART_STORAGE == 'cookie':
+        # merge the cart from the anonymous visitor's cookie too (the cookie is deleted by CartMiddleware)
+        CookieCart.from_request(request).move_to(user_cart)
\ No newline at end of file
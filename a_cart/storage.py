@@ -0,0 +1,171 @@
+"""
+Where visitors' carts are kept, chosen by the CART_STORAGE setting.
+
+With 'db' every cart is a Cart in the database, tied to an anonymous visitor by their session.
+With 'cookie' an anonymous visitor's cart is a CookieCart instead: the product ids and
+quantities in a signed cookie, so browsing and filling a cart write nothing to the database.
+It's moved into a Cart at checkout, on login (merged into the user's cart), or when it
+outgrows the cookie. Users who are logged in always have a Cart.
+
+Both have the API the views and templates use: get_items, get_item, get_summary,
+get_num_items, get_total_price, add_product, update_quantity, remove_product, for_update
+and materialize.
+"""
+from django.conf import settings
+from a_products.models import Product
+from .models import Cart, CartItem, CartSummary
+
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_SALT = 'a_cart.storage'
+CART_COOKIE_AGE = settings.SESSION_COOKIE_AGE
+CART_COOKIE_MAX_SIZE = 2048  # bytes of payload; larger carts are moved into the database
+
+def get_cart(request):
+    """
+    Get the visitor's cart from the configured storage, without writing to the database.
+
+    Use `request.cart` instead (see a_cart.middleware), which calls this at most once per request.
+    """
+    if settings.CART_STORAGE == 'cookie' and not request.user.is_authenticated and 'cart_id' not in request.session:
+        return CookieCart.from_request(request)
+    return Cart.get_from_request(request)
+
+def save_cookie_cart(request, response):
+    """
+    Write the cookie cart of the request (if it was changed) to its cookie, or delete the
+    cookie if the cart was moved into the database.
+    """
+    cart = getattr(request, '_cookie_cart', None)
+    if cart is None or not (cart.modified or cart.materialized):
+        return
+    if not cart.materialized and len(cart.dumps()) > CART_COOKIE_MAX_SIZE:
+        cart.materialize(request)
+
+    if cart.materialized:
+        response.delete_cookie(CART_COOKIE_NAME, samesite='Lax')
+    else:
+        response.set_signed_cookie(
+            CART_COOKIE_NAME, cart.dumps(), salt=CART_COOKIE_SALT, max_age=CART_COOKIE_AGE,
+            secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+        )
+
+class CookieCart:
+    """
+    An anonymous visitor's cart, kept in a signed cookie (see the module docstring).
+
+    The cookie only holds product ids and quantities, e.g. '12:1,7:3'; the products are read
+    with the items, so their prices are always current.
+    """
+    pk = None
+    user = None
+
+    def __init__(self, quantities=None):
+        self.quantities = dict(quantities or {})  # by product id, in the order they were added
+        self.modified = False  # whether the cookie needs to be written
+        self.materialized = False  # whether the cart was moved into the database
+        self._items = None
+        self._summary = None
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        Get the cart in the request's cookie, read once per request.
+        """
+        if not hasattr(request, '_cookie_cart'):
+            payload = request.get_signed_cookie(CART_COOKIE_NAME, default='', salt=CART_COOKIE_SALT, max_age=CART_COOKIE_AGE)
+            request._cookie_cart = cls(cls.loads(payload))
+        return request._cookie_cart
+
+    @staticmethod
+    def loads(payload):
+        try:
+            quantities = {int(product_id): int(quantity) for product_id, quantity in (line.split(':') for line in payload.split(',') if line)}
+        except ValueError:
+            return {}
+        return {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+
+    def dumps(self):
+        return ','.join(f'{product_id}:{quantity}' for product_id, quantity in self.quantities.items())
+
+    def __str__(self):
+        return "Anonymous cookie cart"
+
+    def get_items(self):
+        """
+        Get the items of the cart as unsaved cart items, with their products and product images.
+        """
+        if self._items is None:
+            products = Product.objects.with_card_images().in_bulk(self.quantities)
+            if len(products) < len(self.quantities):
+                # drop the products that were deleted since they were added
+                self.quantities = {product_id: quantity for product_id, quantity in self.quantities.items() if product_id in products}
+                self.modified = True
+            # the items need a cart for CartItem.__str__; an unsaved one stands in for this cart
+            cart = Cart()
+            self._items = [
+                CartItem(cart=cart, product=products[product_id], quantity=quantity)
+                for product_id, quantity in self.quantities.items()
+            ]
+        return self._items
+
+    def get_item(self, product_id):
+        product_id = int(product_id)
+        for item in self.get_items():
+            if item.product_id == product_id:
+                return item
+        raise CartItem.DoesNotExist(f"The cart has no product {product_id}")
+
+    def get_summary(self):
+        if self._summary is None:
+            self._summary = CartSummary.from_items(self.get_items())
+        return self._summary
+
+    def get_total_price(self):
+        return self.get_summary().total_price
+
+    def get_num_items(self):
+        return self.get_summary().num_items
+
+    def forget_items(self):
+        self.modified = True
+        self._items = None
+        self._summary = None
+
+    def for_update(self, request):
+        return self
+
+    def add_product(self, product, quantity=1):
+        self.quantities[product.pk] = self.quantities.get(product.pk, 0) + quantity
+        self.forget_items()
+        return self.get_item(product.pk)
+
+    def update_quantity(self, product_id, quantity):
+        product_id = self.get_item(product_id).product_id
+        self.quantities[product_id] = quantity
+        self.forget_items()
+
+    def remove_product(self, product_id):
+        del self.quantities[self.get_item(product_id).product_id]
+        self.forget_items()
+
+    def move_to(self, cart):
+        """
+        Add the items to a cart in the database, which replaces this cart (its cookie is deleted).
+
+        Returns:
+            The cart.
+        """
+        # drop the products that were deleted since they were added (the items may not have been read in this request)
+        existing = set(Product.objects.filter(pk__in=self.quantities).values_list('pk', flat=True))
+        cart.add_quantities({product_id: quantity for product_id, quantity in self.quantities.items() if product_id in existing})
+        self.materialized = True
+        return cart
+
+    def materialize(self, request):
+        """
+        Move the cart into the database: into the cart of the request (see Cart.get_from_request).
+
+        Returns:
+            The saved cart.
+        """
+        return self.move_to(Cart.get_from_request(request).materialize(request))
@@ -1,8 +1,21 @@
-from django.test import TestCase, Client
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import IntegrityError, connection, connections, transaction
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
-from django.contrib.auth.models import User
-from a_products.models import Product, Category
+from a_orders.models import Order
+from a_products.models import Category, Product
+from .management.commands.stress_cart_adds import add_repeatedly
+from .middleware import CartMiddleware
 from .models import Cart, CartItem
+from .storage import CART_COOKIE_NAME, CookieCart
 
 class CartModelTest(TestCase):
     def setUp(self):
@@ -20,6 +33,45 @@ class CartModelTest(TestCase):
         self.assertEqual(self.cart.items.count(), 1)
         self.assertEqual(self.cart.items.first().quantity, 2)
 
+    def test_add_product_again_increments_the_quantity(self):
+        first_item = self.cart.add_product(self.product, quantity=2)
+        # one statement, which inserts or increments
+        with self.assertNumQueries(1):
+            item = self.cart.add_product(self.product, quantity=3)
+        self.assertEqual((item.pk, item.quantity, item.added_at), (first_item.pk, 5, first_item.added_at))
+        self.assertEqual(list(self.cart.items.values_list('quantity', flat=True)), [5])
+
+    def test_cart_has_one_item_per_product(self):
+        self.cart.add_product(self.product)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CartItem.objects.create(cart=self.cart, product=self.product)
+
+    def test_merge_with(self):
+        other_product = Product.objects.create(name='Other Product', price=5.00, category=self.category)
+        self.cart.add_product(self.product, quantity=2)
+        anonymous_cart = Cart.objects.create()
+        anonymous_cart.add_product(self.product)
+        anonymous_cart.add_product(other_product, quantity=3)
+
+        self.cart.merge_with(anonymous_cart)
+        self.assertEqual(dict(self.cart.items.values_list('product_id', 'quantity')), {self.product.id: 3, other_product.id: 3})
+        self.assertEqual(self.cart.get_num_items(), 6)
+        self.assertFalse(Cart.objects.filter(pk=anonymous_cart.pk).exists())
+
+    def test_merge_with_query_count_does_not_grow_with_items(self):
+        products = [Product.objects.create(name=f'Product {i}', price=1.00) for i in range(20)]
+
+        def count_merge_queries(num_items):
+            anonymous_cart = Cart.objects.create()
+            for product in products[:num_items]:
+                anonymous_cart.add_product(product)
+            with CaptureQueriesContext(connection) as queries:
+                self.cart.merge_with(anonymous_cart)
+            return len(queries)
+
+        self.assertEqual(count_merge_queries(1), count_merge_queries(20))
+        self.assertEqual(self.cart.get_num_items(), 21)
+
     def test_remove_product(self):
         self.cart.add_product(self.product)
         self.cart.remove_product(self.product.id)
@@ -38,6 +90,264 @@ class CartModelTest(TestCase):
         self.cart.add_product(self.product, quantity=2)
         self.assertEqual(self.cart.get_num_items(), 2)
 
+class ConcurrentAddTest(TransactionTestCase):
+    # the worker processes write to the test database themselves, so it can't be wrapped in a transaction
+    processes = 4
+    adds = 25
+
+    def setUp(self):
+        self.product = Product.objects.create(name='Test Product', price=10.00)
+        self.cart = Cart.objects.create()
+
+    def add_from_processes(self, mode):
+        # fork without an open connection, so each process opens its own
+        connections.close_all()
+        with ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('fork')) as executor:
+            results = list(executor.map(add_repeatedly, *zip(*[(mode, self.cart.pk, self.product.pk, self.adds)] * self.processes)))
+        return sum(result[0] for result in results), sum(result[1] for result in results)
+
+    def test_concurrent_adds_are_all_counted(self):
+        for mode in ['upsert', 'bulk-upsert']:
+            with self.subTest(mode=mode):
+                self.cart.items.all().delete()
+                succeeded, failed = self.add_from_processes(mode)
+                self.assertEqual((succeeded, failed), (self.processes * self.adds, 0))
+                self.assertEqual(list(self.cart.items.values_list('quantity', flat=True)), [succeeded])
+
+
+class CartSummaryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+        self.cart = Cart.objects.create(user=self.user)
+        self.products = [Product.objects.create(name=f'Product {i}', price='10.10') for i in range(5)]
+
+    def test_summary(self):
+        self.cart.add_product(self.products[0], quantity=3)
+        self.cart.add_product(self.products[1])
+        with self.assertNumQueries(1):
+            summary = self.cart.get_summary()
+            self.assertEqual((summary.num_items, summary.num_lines, summary.total_price), (4, 2, Decimal('40.40')))
+            self.assertEqual((self.cart.get_num_items(), self.cart.get_total_price()), (4, Decimal('40.40')))
+
+        # mutations clear the memoized summary
+        self.cart.update_quantity(self.products[0].id, 1)
+        self.assertEqual(self.cart.get_num_items(), 2)
+        self.cart.remove_product(self.products[1].id)
+        self.assertEqual(self.cart.get_summary().num_lines, 1)
+
+    def test_empty_summary(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.cart.get_total_price(), Decimal('0.00'))
+        with self.assertNumQueries(0):
+            self.assertEqual(Cart().get_summary().num_items, 0)
+
+    def test_cart_page_query_count_does_not_grow_with_lines(self):
+        self.cart.add_product(self.products[0], quantity=2)
+        # the session, the user, the cart, its items (with their products and images, which also
+        # give the summary) and the session save (SESSION_SAVE_EVERY_REQUEST)
+        with self.assertNumQueries(7):
+            response = self.client.get(reverse('cart:view_cart'))
+        self.assertContains(response, '<span id="total-product">2</span>', html=True)
+
+        for product in self.products[1:]:
+            self.cart.add_product(product)
+        with self.assertNumQueries(7):
+            response = self.client.get(reverse('cart:view_cart'))
+        self.assertContains(response, '<span id="total-product">6</span>', html=True)
+        self.assertContains(response, '€60.60')
+
+    def test_navbar_menus_query_count(self):
+        for product in self.products:
+            self.cart.add_product(product)
+        # the session, the user, the cart, its items, the profile and the session save (SESSION_SAVE_EVERY_REQUEST)
+        with self.assertNumQueries(8):
+            response = self.client.get(reverse('cart:navbar_menus'))
+        self.assertContains(response, '5 Items')
+
+
+class LazyCartTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.product = Product.objects.create(name='Test Product', price=10.00)
+
+    def make_request(self, user=None):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        request.user = user or AnonymousUser()
+        return request
+
+    def test_get_from_request_does_not_write(self):
+        request = self.make_request()
+        with self.assertNumQueries(0):
+            cart = Cart.get_from_request(request)
+            self.assertEqual((cart.pk, cart.get_num_items(), cart.get_total_price(), cart.get_items().count()), (None, 0, 0, 0))
+        self.assertTrue(request.session.is_empty())
+
+        with CaptureQueriesContext(connection) as queries:
+            cart = Cart.get_from_request(self.make_request(self.user))
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]['sql'].startswith('SELECT'))
+        self.assertEqual((cart.pk, cart.user), (None, self.user))
+
+    def test_materialize(self):
+        request = self.make_request()
+        cart = Cart.get_from_request(request).materialize(request)
+        self.assertIsNotNone(cart.pk)
+        self.assertEqual(request.session['cart_id'], cart.pk)
+        cart.add_product(self.product)
+        self.assertEqual(Cart.get_from_request(request).get_num_items(), 1)
+
+    def test_materialize_uses_a_concurrently_created_user_cart(self):
+        request = self.make_request(self.user)
+        cart = Cart.get_from_request(request)
+        existing_cart = Cart.objects.create(user=self.user)
+        self.assertEqual(cart.materialize(request), existing_cart)
+        self.assertEqual(Cart.objects.count(), 1)
+
+
+class CartMiddlewareTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.cart = Cart.objects.create(user=self.user)
+        self.products = [Product.objects.create(name=f'Product {i}', price='10.10') for i in range(3)]
+        for product in self.products:
+            self.cart.add_product(product, quantity=2)
+
+    def make_request(self, user=None):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        request.user = user or AnonymousUser()
+        CartMiddleware(lambda request: None)(request)
+        return request
+
+    def test_untouched_cart_is_not_fetched(self):
+        with self.assertNumQueries(0):
+            self.make_request(self.user)
+
+    def test_cart_is_fetched_once_with_its_items(self):
+        request = self.make_request(self.user)
+        # the cart, and its items with their products and images
+        with self.assertNumQueries(2):
+            self.assertEqual(request.cart.pk, self.cart.pk)
+            self.assertEqual(request.cart.get_summary().num_lines, 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(request.cart.get_num_items(), 6)
+            self.assertEqual(request.cart.get_total_price(), Decimal('60.60'))
+            self.assertEqual([item.product.get_primary_image() for item in request.cart.get_items()], [None] * 3)
+
+    def test_changes_refetch_the_items(self):
+        request = self.make_request(self.user)
+        request.cart.remove_product(self.products[0].id)
+        self.assertEqual(request.cart.get_summary().num_lines, 2)
+        self.assertEqual(len(request.cart.get_items()), 2)
+
+    def test_anonymous_cart(self):
+        request = self.make_request()
+        with self.assertNumQueries(0):
+            self.assertIsNone(request.cart.pk)
+
+        anonymous_cart = Cart.objects.create()
+        request = self.make_request()
+        request.session['cart_id'] = anonymous_cart.pk
+        self.assertEqual(request.cart.pk, anonymous_cart.pk)
+
+        # a user's cart is never an anonymous visitor's cart
+        request = self.make_request()
+        request.session['cart_id'] = self.cart.pk
+        self.assertIsNone(request.cart.pk)
+
+
+@override_settings(CART_STORAGE='cookie')
+class CookieCartTest(TestCase):
+    def setUp(self):
+        self.products = [Product.objects.create(name=f'Product {i}', price='10.10') for i in range(3)]
+
+    def add(self, product, quantity=1):
+        return self.client.post(reverse('cart:add_to_cart'), {'product_id': product.id, 'quantity': quantity}, HTTP_HX_REQUEST='true')
+
+    def test_anonymous_cart_views_do_not_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.add(self.products[0], quantity=2)
+            self.add(self.products[1])
+            self.add(self.products[0])
+            self.client.post(reverse('cart:update_quantity'), {'product_id': self.products[1].id, 'quantity': 4}, HTTP_HX_REQUEST='true')
+            response = self.client.get(reverse('cart:view_cart'))
+        self.assertFalse([query['sql'] for query in queries if not query['sql'].startswith('SELECT')])
+        self.assertEqual(Cart.objects.count(), 0)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        self.assertContains(response, '<span id="total-product">7</span>', html=True)
+        self.assertContains(response, '€70.70')
+
+    def test_remove_from_cart(self):
+        self.add(self.products[0])
+        self.add(self.products[1])
+        response = self.client.post(reverse('cart:remove_from_cart'), {'product_id': self.products[0].id}, HTTP_HX_REQUEST='true')
+        self.assertNotContains(response, self.products[0].name)
+        self.assertContains(self.client.get(reverse('cart:navbar_menus')), '1 Items')
+
+    def test_cookie_is_signed(self):
+        self.add(self.products[0])
+        self.assertNotEqual(self.client.cookies[CART_COOKIE_NAME].value, f'{self.products[0].id}:1')
+        self.client.cookies[CART_COOKIE_NAME] = f'{self.products[1].id}:5'
+        self.assertContains(self.client.get(reverse('cart:navbar_menus')), '0 Items')
+
+    def test_deleted_products_are_dropped(self):
+        self.add(self.products[0])
+        self.add(self.products[1])
+        self.products[0].delete()
+        self.assertContains(self.client.get(reverse('cart:navbar_menus')), '1 Items')
+
+    def test_large_cart_is_moved_into_the_database(self):
+        self.add(self.products[0])
+        with mock.patch('a_cart.storage.CART_COOKIE_MAX_SIZE', 5):
+            response = self.add(self.products[1], quantity=2)
+        self.assertEqual(response.cookies[CART_COOKIE_NAME].value, '')
+        cart = Cart.objects.get(pk=self.client.session['cart_id'])
+        self.assertEqual(cart.get_num_items(), 3)
+        # the visitor's cart is in the database from now on
+        response = self.add(self.products[2])
+        self.assertNotIn(CART_COOKIE_NAME, response.cookies)
+        self.assertEqual(Cart.objects.get(pk=cart.pk).get_num_items(), 4)
+
+    def test_login_merges_the_cart_into_the_users_cart(self):
+        user = User.objects.create_user(username='testuser', email='test@example.com', password='12345')
+        Cart.objects.create(user=user).add_product(self.products[0])
+        self.add(self.products[0])
+        self.add(self.products[1], quantity=2)
+
+        response = self.client.post(reverse('account_login'), {'login': 'test@example.com', 'password': '12345'})
+        self.assertEqual(response.cookies[CART_COOKIE_NAME].value, '')
+        cart = Cart.objects.get(user=user)
+        self.assertEqual(dict(cart.items.values_list('product_id', 'quantity')), {self.products[0].id: 2, self.products[1].id: 2})
+        self.assertContains(self.client.get(reverse('cart:navbar_menus')), '2 Items')
+
+    def test_login_drops_deleted_products(self):
+        User.objects.create_user(username='testuser', email='test@example.com', password='12345')
+        self.add(self.products[0])
+        self.add(self.products[1])
+        self.products[0].delete()
+
+        self.client.post(reverse('account_login'), {'login': 'test@example.com', 'password': '12345'})
+        # the test transaction defers foreign key checks, which would otherwise fail on commit
+        connection.check_constraints()
+        self.assertEqual(list(CartItem.objects.values_list('product_id', 'quantity')), [(self.products[1].id, 1)])
+
+    def test_checkout_moves_the_cart_into_the_database(self):
+        self.add(self.products[0], quantity=2)
+        response = self.client.get(reverse('orders:checkout_contact'))
+        self.assertEqual(response.cookies[CART_COOKIE_NAME].value, '')
+        cart = Cart.objects.get(pk=self.client.session['cart_id'])
+        self.assertEqual(cart.get_num_items(), 2)
+        self.assertEqual(Order.objects.get(pk=self.client.session['order_id']).items.get().quantity, 2)
+
+    def test_payload(self):
+        cart = CookieCart({self.products[0].id: 2, self.products[1].id: 1})
+        self.assertEqual(CookieCart.loads(cart.dumps()), cart.quantities)
+        self.assertEqual(CookieCart.loads('1:2,x:1'), {})
+        self.assertEqual(CookieCart.loads('1:2,3:0'), {1: 2})
+
+
 class CartViewsTest(TestCase):
     def setUp(self):
         self.client = Client()
@@ -76,6 +386,20 @@ class CartViewsTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'cart/cart_content.html')
 
+    def test_add_to_cart_htmx_updates_the_navbar(self):
+        response = self.client.post(reverse('cart:add_to_cart'), {'product_id': self.product.id, 'quantity': 1}, HTTP_HX_REQUEST='true')
+        self.assertIn('cart-updated', json.loads(response['HX-Trigger']))
+
+    def test_navbar_menus(self):
+        cart = Cart.objects.create(user=self.user)
+        cart.add_product(self.product, quantity=2)
+        response = self.client.get(reverse('cart:navbar_menus'))
+        self.assertContains(response, '1 Items')
+        self.assertContains(response, 'Logout')
+        # the pages read the CSRF token from the cookie
+        self.assertIn('csrftoken', response.cookies)
+        self.assertIn('no-cache', response['Cache-Control'])
+
     def test_remove_from_cart_htmx(self):
         cart = Cart.objects.create(user=self.user)
         cart.add_product(self.product)
@@ -25,4 +25,5 @@ urlpatterns = [
     path('add/', views.add_to_cart, name='add_to_cart'),
     path('remove/', views.remove_from_cart, name='remove_from_cart'),
     path('update/', views.update_quantity, name='update_quantity'),
+    path('navbar/', views.view_navbar_menus, name='navbar_menus'),
 ]
@@ -1,46 +1,63 @@
 from django.shortcuts import render
-from .models import Cart
 from a_products.models import Product
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django_htmx.http import trigger_client_event
+
+# the event that makes the navbar reload its cart menu (see cotton/navbar.html)
+CART_UPDATED_EVENT = 'cart-updated'
 
 def view_cart(request):
-    cart, created = Cart.get_or_create_from_request(request)
+    cart = request.cart
     return render(request, 'cart/cart.html', {'cart': cart})
 
+@never_cache
+@ensure_csrf_cookie
+def view_navbar_menus(request):
+    """
+    Render the per-visitor part of the navbar: the cart and user menus.
+
+    Every page loads this fragment with htmx, so that the pages themselves hold no per-visitor
+    data and can be cached. It also sets the CSRF cookie, which the pages' scripts read their
+    token from.
+    """
+    cart = request.cart
+    return render(request, 'cart/partials/navbar_menus.html', {'cart': cart})
+
 def add_to_cart(request):
     if request.method == 'POST':
         product_id = request.POST.get('product_id')
         quantity = int(request.POST.get('quantity', 1))
 
         if product_id:
-            cart, created = Cart.get_or_create_from_request(request)
+            cart = request.cart.for_update(request)
             product = Product.objects.get(id=product_id)
             cart.add_product(product, quantity)
             if request.htmx:
-                return render(request, 'cart/cart_content.html', {'cart': cart})
+                return trigger_client_event(render(request, 'cart/cart_content.html', {'cart': cart}), CART_UPDATED_EVENT)
             return render(request, 'cart/cart.html', {'cart': cart})
     return render(request, 'cart/cart.html', {'error': 'Invalid product or quantity'})
 
 def remove_from_cart(request):
     if request.method == 'POST':
         product_id = request.POST.get('product_id')
-        cart, created = Cart.get_or_create_from_request(request)
+        cart = request.cart
         cart.remove_product(product_id)
         if request.htmx:
-            return render(request, 'cart/cart_content.html', {'cart': cart})
+            return trigger_client_event(render(request, 'cart/cart_content.html', {'cart': cart}), CART_UPDATED_EVENT)
         return render(request, 'cart/cart.html', {'cart': cart})
     return render(request, 'cart/cart.html', {'error': 'Invalid product'})
 
 def update_quantity(request):
-    cart, created = Cart.get_or_create_from_request(request)
+    cart = request.cart
     product_id = request.POST.get('product_id')
     quantity = int(request.POST.get('quantity', 1))
     print(f"Updating quantity for product {product_id} to {quantity}")
     cart.update_quantity(product_id, quantity)
     if request.htmx:
-        updated_item = cart.items.get(product_id=product_id)
-        num_items = cart.get_num_items()
-        total_price = cart.get_total_price()
-        context = {'item': updated_item, 'num_items': num_items, 'total_price': total_price}
-        return render(request, 'cart/partials/cart_row.html', context)
+        updated_item = cart.get_item(product_id)
+        summary = cart.get_summary()
+        context = {'item': updated_item, 'num_items': summary.num_items, 'total_price': summary.total_price}
+        return trigger_client_event(render(request, 'cart/partials/cart_row.html', context), CART_UPDATED_EVENT)
     return render(request, 'cart/cart.html', {'cart': cart})
\ No newline at end of file
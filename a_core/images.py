@@ -0,0 +1,188 @@
+"""
+Image derivatives: resized copies of uploaded images in modern formats, for `srcset` and `<picture>`.
+
+When a model saves a new image, `schedule_derivatives` queues the generation for after the
+transaction commits. A process pool (IMAGE_DERIVATIVE_WORKERS) resizes the image with Pillow
+to the IMAGE_DERIVATIVE_WIDTHS in the IMAGE_DERIVATIVE_FORMATS, away from the request path.
+The result is recorded in a JSON field next to the image:
+
+    {'source': 'product_images/<sha256>.jpg', 'width': 2000, 'height': 1500,
+     'formats': {'webp': [{'width': 320, 'height': 240, 'name': 'derivatives/product_images/<sha256>.webp'}, ...], ...},
+     'placeholder': 'data:image/webp;base64,...'}
+
+Templates render these with `get_picture_sources` and `get_placeholder`. Until the derivatives
+exist (or when the image changed since), the original image is served as before.
+"""
+import base64
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction, close_old_connections
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVES_DIR = 'derivatives'
+PLACEHOLDER_WIDTH = 16  # scaled up by the browser, which blurs it; a few hundred bytes inline
+# format name -> (Pillow format, mime type)
+FORMATS = {
+    'avif': ('AVIF', 'image/avif'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+
+def get_encodable_formats(formats):
+    """
+    Drop the formats the installed Pillow can't encode (e.g. AVIF without libavif support).
+    """
+    Image.init()
+    encodable = [fmt for fmt in formats if FORMATS[fmt][0] in Image.SAVE]
+    if len(encodable) < len(formats):
+        logger.warning("Pillow can't encode %s; skipping these image derivatives", ', '.join(sorted(set(formats) - set(encodable))))
+    return encodable
+
+def generate_derivatives(name, widths=None, formats=None, quality=None):
+    """
+    Generate the derivatives of a stored image. Runs in the worker processes, so it only deals in plain data.
+
+    Images are never upscaled: widths above the original width are replaced by the original width.
+
+    :param name: The storage name of the original image
+    :param widths: The widths to generate (defaults to IMAGE_DERIVATIVE_WIDTHS)
+    :param formats: The formats to generate (defaults to IMAGE_DERIVATIVE_FORMATS); those Pillow can't encode are skipped
+    :return: The derivatives, as recorded in the model's JSON field
+    """
+    widths = widths or settings.IMAGE_DERIVATIVE_WIDTHS
+    formats = get_encodable_formats(formats or settings.IMAGE_DERIVATIVE_FORMATS)
+    quality = quality or settings.IMAGE_DERIVATIVE_QUALITY
+
+    with default_storage.open(name) as file:
+        image = Image.open(file)
+        image.load()
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+
+    stem = os.path.splitext(name)[0]
+    derivatives = {'source': name, 'width': image.width, 'height': image.height, 'formats': {}}
+    for fmt in formats:
+        pil_format = FORMATS[fmt][0]
+        variants = []
+        for width in sorted({min(width, image.width) for width in widths}):
+            height = round(image.height * width / image.width)
+            resized = image if width == image.width else image.resize((width, height), Image.Resampling.LANCZOS)
+            if pil_format == 'JPEG' and resized.mode != 'RGB':
+                resized = resized.convert('RGB')
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, quality=quality)
+            # the storage names the file by its content hash (see a_core.storage), keeping the directory and
+            # extension, so identical derivatives are stored once; the recorded names of the derivatives of a
+            # replaced image are ignored by get_picture_sources, as their 'source' no longer matches
+            derivative_name = default_storage.save(f'{DERIVATIVES_DIR}/{stem}-{width}.{fmt}', ContentFile(buffer.getvalue()))
+            variants.append({'width': width, 'height': height, 'name': derivative_name})
+        derivatives['formats'][fmt] = variants
+    derivatives['placeholder'] = make_placeholder(image)
+    return derivatives
+
+def make_placeholder(image):
+    """
+    Encode a tiny, low quality version of an image as a WebP data URI, to inline while the real image loads.
+    """
+    height = max(1, round(image.height * PLACEHOLDER_WIDTH / image.width))
+    buffer = io.BytesIO()
+    image.resize((PLACEHOLDER_WIDTH, height), Image.Resampling.BILINEAR).save(buffer, 'WEBP', quality=30)
+    return f"data:image/webp;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+def needs_derivatives(field_file, derivatives):
+    """
+    Whether an image field has an image without (up-to-date) derivatives.
+    """
+    derivatives = derivatives or {}
+    # derivatives recorded before placeholders were added lack one
+    return bool(field_file) and (derivatives.get('source') != field_file.name or 'placeholder' not in derivatives)
+
+def get_picture_sources(field_file, derivatives):
+    """
+    Build the `<source>` elements of a `<picture>` from the derivatives of an image field.
+
+    :return: A list of dictionaries with the 'type' and 'srcset' of each format, best format first;
+        empty if there are no derivatives for the current image
+    """
+    if not field_file or (derivatives or {}).get('source') != field_file.name:
+        return []
+    sources = []
+    for fmt, variants in derivatives['formats'].items():
+        srcset = ', '.join(f"{default_storage.url(variant['name'])} {variant['width']}w" for variant in variants)
+        sources.append({'type': FORMATS[fmt][1], 'srcset': srcset})
+    return sources
+
+def get_placeholder(field_file, derivatives):
+    """
+    :return: The placeholder data URI of an image field, or None if there is none for the current image
+    """
+    if not field_file or (derivatives or {}).get('source') != field_file.name:
+        return None
+    return derivatives.get('placeholder')
+
+def record_derivatives(model, pk, field_name, derivatives_field, derivatives):
+    """
+    Save generated derivatives on their instance, unless its image changed in the meantime.
+
+    This goes through `save()`, so the model's signals see the change (e.g. to invalidate caches).
+    """
+    instance = model.objects.filter(pk=pk, **{field_name: derivatives['source']}).first()
+    if instance is None:
+        return False
+    setattr(instance, derivatives_field, derivatives)
+    instance.save(update_fields=[derivatives_field])
+    return True
+
+def _init_worker():
+    import django
+    django.setup()
+
+_executor = None
+
+def get_executor(max_workers=None):
+    """
+    Return the process pool for generating derivatives, started on first use.
+    """
+    global _executor
+    if max_workers is not None:
+        # a dedicated pool, e.g. for a backfill
+        return ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+    if _executor is None:
+        # spawn rather than fork, as forking a threaded web server process isn't safe
+        _executor = ProcessPoolExecutor(settings.IMAGE_DERIVATIVE_WORKERS, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+    return _executor
+
+def schedule_derivatives(instance, field_name, derivatives_field):
+    """
+    Generate the derivatives of an instance's image once the current transaction commits.
+
+    With IMAGE_DERIVATIVE_WORKERS set to 0 they're generated in-process instead (e.g. for tests).
+    """
+    model = type(instance)
+    pk = instance.pk
+    name = getattr(instance, field_name).name
+
+    def on_done(future):
+        try:
+            record_derivatives(model, pk, field_name, derivatives_field, future.result())
+        except Exception:
+            logger.exception("Failed to generate the derivatives of %s", name)
+        finally:
+            close_old_connections()
+
+    def submit():
+        if settings.IMAGE_DERIVATIVE_WORKERS:
+            get_executor().submit(generate_derivatives, name).add_done_callback(on_done)
+        else:
+            record_derivatives(model, pk, field_name, derivatives_field, generate_derivatives(name))
+
+    transaction.on_commit(submit)
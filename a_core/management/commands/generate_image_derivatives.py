@@ -0,0 +1,44 @@
+import os
+import time
+from concurrent.futures import as_completed
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from a_core.images import generate_derivatives, needs_derivatives, record_derivatives, get_executor
+
+# (model, image field, derivatives field) of every image with derivatives
+IMAGE_FIELDS = [
+    ('a_products.ProductImage', 'image', 'derivatives'),
+    ('a_profiles.Profile', 'avatar', 'avatar_derivatives'),
+]
+
+class Command(BaseCommand):
+    help = "Generate the missing (or outdated) image derivatives of existing images, in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--force', action='store_true', help="Regenerate the derivatives of all images")
+
+    def handle(self, *args, **options):
+        jobs = []
+        for model_label, field_name, derivatives_field in IMAGE_FIELDS:
+            model = apps.get_model(model_label)
+            rows = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+            for instance in rows.only('pk', field_name, derivatives_field).iterator():
+                if options['force'] or needs_derivatives(getattr(instance, field_name), getattr(instance, derivatives_field)):
+                    jobs.append((model, instance.pk, field_name, derivatives_field, getattr(instance, field_name).name))
+
+        start = time.perf_counter()
+        generated = failed = 0
+        with get_executor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(generate_derivatives, job[-1]): job for job in jobs}
+            for future in as_completed(futures):
+                model, pk, field_name, derivatives_field, name = futures[future]
+                try:
+                    record_derivatives(model, pk, field_name, derivatives_field, future.result())
+                    generated += 1
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write(f"{name}: {error}")
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f"Generated derivatives for {generated} images in {elapsed:.1f}s ({failed} failed)"))
@@ -109,6 +109,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'a_cart.middleware.CartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django_htmx.middleware.HtmxMiddleware',
@@ -153,10 +154,32 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # seconds to wait for another connection's write lock (e.g. concurrent cart updates) before failing
+            'timeout': 20,
+        },
+        # a file rather than SQLite's default in-memory test database, so tests can write to it from several processes
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# The catalog and taxonomy versions in the cache tell every worker process (and management commands
+# like import_products) when to drop their in-process registries, bitmap index and cached pages,
+# so the cache has to be shared between processes; a per-process LocMemCache would keep them stale.
+# The file cache is shared by the processes on one host; use e.g. CACHE_URL=redis://127.0.0.1:6379/1 across hosts.
+CACHES = {
+    'default': env.cache('CACHE_URL', default=f'filecache://{BASE_DIR / "cache"}?max_entries=10000'),
+}
+
+# runs the tests with a cache of their own, in a temporary directory (see a_core/test_runner.py)
+TEST_RUNNER = 'a_core.test_runner.TestRunner'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -217,13 +240,32 @@ STORAGES = {
         "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage",
     },
     "default": {
-        "BACKEND": "django.core.files.storage.FileSystemStorage",
+        # a FileSystemStorage naming files by their content hash (see a_core/storage.py)
+        "BACKEND": "a_core.storage.ContentAddressedStorage",
     }
 }
 
 MEDIA_ROOT = BASE_DIR / 'media/'
 MEDIA_URL = 'media/'
 
+# Image derivatives (see a_core/images.py)
+IMAGE_DERIVATIVE_WIDTHS = [160, 320, 640, 1280]
+# best format first; 'avif' needs a Pillow built with AVIF support (or the pillow-avif-plugin), otherwise it's skipped
+IMAGE_DERIVATIVE_FORMATS = ['webp']
+IMAGE_DERIVATIVE_QUALITY = 75
+# Size of the process pool generating derivatives; 0 generates them in the saving process
+IMAGE_DERIVATIVE_WORKERS = env.int('IMAGE_DERIVATIVE_WORKERS', default=2)
+
+# Catalog
+# Evaluate product filters with an in-process bitmap index instead of SQL joins (see a_products/bitmap_index.py)
+PRODUCT_BITMAP_INDEX = env.bool('PRODUCT_BITMAP_INDEX', default=False)
+# Width of the price histogram buckets shown above the price filter
+PRODUCT_PRICE_BUCKET_WIDTH = env.int('PRODUCT_PRICE_BUCKET_WIDTH', default=10)
+
+# Cart
+# Where anonymous visitors' carts are kept: 'db', or 'cookie' for a signed cookie until checkout or login (see a_cart/storage.py)
+CART_STORAGE = env('CART_STORAGE', default='db')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -0,0 +1,41 @@
+"""
+Content-addressed media storage.
+
+Files are named by the SHA-256 of their content (keeping the directory from `upload_to` and
+the extension), so identical uploads are stored once, and a file name never points to
+different content. That makes media safe to cache forever (see `a_core.views.serve_media`).
+"""
+import hashlib
+import os
+import re
+from django.core.files.storage import FileSystemStorage
+
+CONTENT_NAME_RE = re.compile(r'(^|/)[0-9a-f]{64}(\.\w+)?$')
+
+def is_content_addressed(name):
+    return bool(CONTENT_NAME_RE.search(name))
+
+class ContentAddressedStorage(FileSystemStorage):
+    def _save(self, name, content):
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            return name  # identical content is stored already
+        saved_name = super()._save(name, content)
+        if saved_name != name:
+            # a concurrent upload of the same content created the file first (FileSystemStorage then
+            # picks a random suffix); keep the content-addressed copy instead
+            self.delete(saved_name)
+        return name
+
+    def get_content_name(self, name, content):
+        """
+        Replace the file name (but not its directory) by the hash of the content.
+        """
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, f"{digest.hexdigest()}{extension}")
@@ -0,0 +1,30 @@
+"""
+Test runner giving the test run its own cache.
+
+The tests clear the cache and bump the catalog and taxonomy versions in it, so they must not use
+the cache of the CACHES setting, which a running development server shares. They get a
+FileBasedCache in a temporary directory instead, which (like the real one) is shared between
+processes, so tests can still check that changes reach other processes.
+"""
+import shutil
+import tempfile
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_dir = tempfile.mkdtemp(prefix='test_cache_')
+        self.cache_settings = override_settings(CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': self.cache_dir,
+                'OPTIONS': {'MAX_ENTRIES': 10000},
+            },
+        })
+        self.cache_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_settings.disable()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
@@ -16,8 +16,8 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from django.conf.urls.static import static
 from django.conf import settings
+from .views import serve_media
 
 urlpatterns = [
     path('thebaws/', admin.site.urls),
@@ -29,4 +29,8 @@ urlpatterns = [
     path('orders/', include('a_orders.urls')),
 ]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+if settings.DEBUG:
+    # in production the web server serves MEDIA_ROOT itself (see a_core.views.serve_media)
+    urlpatterns += [
+        path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", serve_media, name='media'),
+    ]
\ No newline at end of file
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.views.static import serve
+from .storage import is_content_addressed
+import time
+
+MEDIA_MAX_AGE = 60 * 60 * 24 * 365  # 1 year
+
+def serve_media(request, path):
+    r"""
+    Serve uploaded media during development. Content-addressed files never change, so browsers may cache them without ever revalidating.
+
+    Only routed with DEBUG on, as `django.views.static.serve` isn't meant for production. There, the web
+    server or CDN serves MEDIA_ROOT and sets the same headers for content-addressed names, e.g. with nginx:
+
+        location ~ "^/media/(.*/)?[0-9a-f]{64}(\.\w+)?$" {
+            root /path/to/project;
+            add_header Cache-Control "public, max-age=31536000, immutable";
+            expires 1y;
+        }
+    """
+    response = serve(request, path, document_root=settings.MEDIA_ROOT)
+    if response.status_code == 200 and is_content_addressed(path):
+        patch_cache_control(response, public=True, max_age=MEDIA_MAX_AGE, immutable=True)
+        response['Expires'] = http_date(time.time() + MEDIA_MAX_AGE)
+    return response
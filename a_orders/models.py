@@ -131,7 +131,7 @@ class Order(models.Model):
         
         # Update or create items
         updated_product_ids = set()
-        for cart_item in cart.items.all():
+        for cart_item in cart.get_items():
             if cart_item.product_id in existing_items:
                 # Update existing item
                 order_item = existing_items[cart_item.product_id]
@@ -5,7 +5,6 @@ from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from .models import Order, Address
-from a_cart.models import Cart
 from .forms import ContactForm, AddressForm
 import logging
 import stripe
@@ -21,7 +20,10 @@ def checkout_contact(request):
 
     # Sync with cart only on non-HTMX GET requests
     if request.method == 'GET' and not request.htmx:
-        cart, _ = Cart.get_or_create_from_request(request)
+        cart = request.cart
+        if cart.get_summary().num_lines:
+            # checkout works from a cart in the database, also with CART_STORAGE = 'cookie'
+            cart = cart.materialize(request)
         order.sync_with_cart(cart)
 
     # Process the contact form
@@ -37,4 +37,10 @@ class ProductAdmin(admin.ModelAdmin):
     list_filter = ('category', 'material', 'purpose', 'body_parts')
     search_fields = ('name', 'description')
     readonly_fields = ('slug', 'created_at', 'updated_at')
-    filter_horizontal = ('purpose', 'body_parts')
\ No newline at end of file
+    filter_horizontal = ('purpose', 'body_parts')
+
+    def get_search_results(self, request, queryset, search_term):
+        # use the full-text index instead of icontains scans over name and description
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.search(search_term), False
\ No newline at end of file
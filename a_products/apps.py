@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'a_products'
+
+    # import signals
+    def ready(self):
+        import a_products.signals
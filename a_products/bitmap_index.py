@@ -0,0 +1,219 @@
+"""
+Optional in-process bitmap index for evaluating product filters.
+
+Every facet option (a category, purpose, material or body part) maps to a bitset of the
+ids of the products that have it, stored as a Python int. A filter set is answered with
+bitwise OR within a facet and AND across facets, followed by a single `id__in` fetch,
+instead of joining the taxonomy and M2M tables on every request.
+
+The index is enabled with the PRODUCT_BITMAP_INDEX setting, built lazily on first use
+and kept up to date incrementally by the signals in `a_products.signals`. Changes made
+by other processes are detected through the catalog version, which triggers a rebuild.
+"""
+import json
+import re
+import threading
+from django.conf import settings
+from django.db import connections
+from django.db.models.expressions import RawSQL
+from .models import Product, Category, Purpose, Material, BodyPart, FILTER_LOOKUPS
+from .utils import normalize_filter_params, get_catalog_version
+
+# facet name -> (taxonomy model, Product field); FK facets are read from the product row, M2M facets from the through table
+FACET_FIELDS = {
+    'category': (Category, 'category'),
+    'purpose': (Purpose, 'purpose'),
+    'material': (Material, 'material'),
+    'body_part': (BodyPart, 'body_parts'),
+}
+
+def ids_to_bitset(ids):
+    """
+    Build a bitset from product ids in one pass (setting bits one by one on an int is quadratic).
+    """
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for product_id in ids:
+        buffer[product_id >> 3] |= 1 << (product_id & 7)
+    return int.from_bytes(buffer, 'little')
+
+def bitset_to_ids(bits):
+    """
+    Return the product ids in a bitset, in ascending order.
+    """
+    return [match.start() for match in re.finditer('1', bin(bits)[:1:-1])]
+
+class FacetBitmapIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._bitmaps = {}  # facet -> {option id: bitset of product ids}
+        self._slugs = {}  # facet -> {slug: option id}
+        self.version = None  # catalog version the index reflects
+        self.is_built = False
+
+    def build(self):
+        """
+        (Re)build the whole index with one query per table.
+        """
+        bitmaps = {}
+        slugs = {}
+        for facet, (model, field_name) in FACET_FIELDS.items():
+            slugs[facet] = {slug: option_id for option_id, slug in model.objects.values_list('id', 'slug')}
+            field = Product._meta.get_field(field_name)
+            if field.many_to_many:
+                rows = field.remote_field.through.objects.values_list(f'{model._meta.model_name}_id', 'product_id')
+            else:
+                rows = Product.objects.filter(**{f'{field.attname}__isnull': False}).values_list(field.attname, 'id')
+            ids_per_option = {}
+            for option_id, product_id in rows.iterator(chunk_size=10000):
+                ids_per_option.setdefault(option_id, []).append(product_id)
+            bitmaps[facet] = {option_id: ids_to_bitset(ids) for option_id, ids in ids_per_option.items()}
+
+        version = get_catalog_version()
+        with self._lock:
+            self._bitmaps = bitmaps
+            self._slugs = slugs
+            self.version = version
+            self.is_built = True
+
+    def ensure_current(self):
+        """
+        Build the index if needed, or rebuild it if the catalog was changed by another process.
+        """
+        if not self.is_built or self.version != get_catalog_version():
+            self.build()
+
+    def mark_current(self, version):
+        """
+        Adopt the catalog version of a committed local change, after its incremental update.
+
+        If the catalog version changed since (e.g. another process bumped it), the index is left
+        stale, so that it's rebuilt with that change too.
+        """
+        if self.is_built and get_catalog_version() == version:
+            self.version = version
+
+    def match(self, params):
+        """
+        Evaluate a filter set: options within a facet are OR-ed, facets are AND-ed.
+
+        :param params: A dictionary of filter parameters (as for `filter_by_params`)
+        :return: A bitset of the matching product ids, or None if no facet filter applies
+        """
+        params = normalize_filter_params(params, FILTER_LOOKUPS)
+        result = None
+        with self._lock:
+            for facet, slugs in params.items():
+                facet_bits = 0
+                for slug in slugs:
+                    option_id = self._slugs[facet].get(slug)
+                    if option_id is not None:
+                        facet_bits |= self._bitmaps[facet].get(option_id, 0)
+                result = facet_bits if result is None else result & facet_bits
+        return result
+
+    def count(self, facet, bits=None):
+        """
+        Count the products per option of a facet, optionally within a bitset of product ids.
+
+        :return: A dictionary of option slug to product count
+        """
+        with self._lock:
+            counts = {}
+            for slug, option_id in self._slugs[facet].items():
+                option_bits = self._bitmaps[facet].get(option_id, 0)
+                count = (option_bits if bits is None else option_bits & bits).bit_count()
+                if count:
+                    counts[slug] = count
+            return counts
+
+    def filter(self, queryset, params):
+        """
+        Apply a filter set to a queryset with a single `id__in` condition.
+        """
+        bits = self.match(params)
+        if bits is None:
+            return queryset
+        ids = bitset_to_ids(bits)
+        connection = connections[queryset.db]
+        if connection.vendor == 'sqlite' and len(ids) > connection.features.max_query_params:
+            # pass large id sets as one JSON parameter instead of one parameter per id
+            return queryset.filter(id__in=RawSQL('SELECT value FROM json_each(%s)', [json.dumps(ids)]))
+        return queryset.filter(id__in=ids)
+
+    # Incremental updates, called from signals
+
+    def set_product_option(self, facet, product_id, option_id):
+        """
+        Set a product's option for an FK facet (clearing its previous one).
+        """
+        with self._lock:
+            bitmaps = self._bitmaps[facet]
+            bit = 1 << product_id
+            for existing_id, bits in bitmaps.items():
+                if bits & bit and existing_id != option_id:
+                    bitmaps[existing_id] = bits & ~bit
+            if option_id is not None:
+                bitmaps[option_id] = bitmaps.get(option_id, 0) | bit
+
+    def add_product_options(self, facet, product_ids, option_ids):
+        with self._lock:
+            bitmaps = self._bitmaps[facet]
+            product_bits = ids_to_bitset(product_ids)
+            for option_id in option_ids:
+                bitmaps[option_id] = bitmaps.get(option_id, 0) | product_bits
+
+    def remove_product_options(self, facet, product_ids, option_ids=None):
+        """
+        Remove options of an M2M facet from products; all of them if option_ids is None.
+        """
+        with self._lock:
+            bitmaps = self._bitmaps[facet]
+            product_bits = ids_to_bitset(product_ids)
+            for option_id in list(bitmaps) if option_ids is None else option_ids:
+                if option_id in bitmaps:
+                    bitmaps[option_id] &= ~product_bits
+
+    def remove_option_products(self, facet, option_id):
+        """
+        Remove an option of an M2M facet from all of its products.
+        """
+        with self._lock:
+            self._bitmaps[facet].pop(option_id, None)
+
+    def remove_product(self, product_id):
+        with self._lock:
+            bit = 1 << product_id
+            for bitmaps in self._bitmaps.values():
+                for option_id, bits in bitmaps.items():
+                    if bits & bit:
+                        bitmaps[option_id] = bits & ~bit
+
+    def set_option_slug(self, facet, option_id, slug):
+        """
+        Register a new or renamed taxonomy option.
+        """
+        with self._lock:
+            slugs = self._slugs[facet]
+            for existing_slug, existing_id in list(slugs.items()):
+                if existing_id == option_id:
+                    del slugs[existing_slug]
+            slugs[slug] = option_id
+
+    def remove_option(self, facet, option_id):
+        with self._lock:
+            self._slugs[facet] = {slug: pk for slug, pk in self._slugs[facet].items() if pk != option_id}
+            self._bitmaps[facet].pop(option_id, None)
+
+product_index = FacetBitmapIndex()
+
+def get_product_index():
+    """
+    Return the up-to-date process-wide index, or None if the PRODUCT_BITMAP_INDEX setting is off.
+    """
+    if not getattr(settings, 'PRODUCT_BITMAP_INDEX', False):
+        return None
+    product_index.ensure_current()
+    return product_index
@@ -0,0 +1,37 @@
+"""
+Cache of the rendered product cards.
+
+Rendering a card (with its nested cotton components) is the main CPU cost of the product
+list, so each card's HTML is cached under the product id and its `updated_at`. Saving a
+product bumps `updated_at` through auto_now, and saving or deleting one of its images
+touches it (see `a_products.signals`), so a changed product simply gets a new cache key.
+"""
+from django.core.cache import cache
+from django.db.models import prefetch_related_objects
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+CARD_TEMPLATE = 'products/partials/product_card.html'
+CARD_CACHE_TIMEOUT = 60 * 60 * 24  # 1 day; stale entries are never read again, this just frees them
+
+def get_card_cache_key(product):
+    return f"a_products:card:{product.pk}:{product.updated_at.timestamp()}"
+
+def render_product_cards(products):
+    """
+    Render the cards of the given products, from the cache where possible.
+
+    Only the products missing from the cache get their card rendered.
+
+    :param products: A list of products, ideally loaded `with_card_images` (otherwise their images are loaded here)
+    :return: A list with the card HTML of every product, in the same order
+    """
+    keys = {product.pk: get_card_cache_key(product) for product in products}
+    cards = cache.get_many(list(keys.values()))
+    missing = [product for product in products if keys[product.pk] not in cards]
+    if missing:
+        prefetch_related_objects(missing, 'primary_image', 'secondary_image')
+        rendered = {keys[product.pk]: render_to_string(CARD_TEMPLATE, {'product': product}) for product in missing}
+        cache.set_many(rendered, CARD_CACHE_TIMEOUT)
+        cards.update(rendered)
+    return [mark_safe(cards[keys[product.pk]]) for product in products]
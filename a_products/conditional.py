@@ -0,0 +1,61 @@
+"""
+Validators (ETag and Last-Modified) for conditional GETs of the catalog pages and feeds.
+
+The catalog state is the high-water mark of `Product.updated_at` (saving or deleting an
+image touches its product, see `a_products.signals`), the number of products (for
+deletions) and the taxonomy version (for renamed options). It's read with one aggregate
+query and cached per catalog version, so validating an unchanged page doesn't query it.
+
+The pages hold no per-visitor data (see `a_products.page_cache`), so their validators
+only depend on the catalog state and the page's parameters.
+"""
+import hashlib
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
+from .models import Product, FILTER_PARAMS
+from .page_cache import cache_catalog_page
+from .taxonomy import get_taxonomy_version
+from .utils import normalize_filter_params, get_catalog_version
+
+CATALOG_STATE_TIMEOUT = 60 * 60  # 1 hour; entries are also invalidated by the catalog version
+
+def get_digest(*parts):
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+def get_catalog_state(request):
+    """
+    Summarize the catalog, once per request.
+
+    :return: A tuple (token, last_modified); last_modified is None for an empty catalog
+    """
+    if not hasattr(request, '_catalog_state'):
+        request._catalog_state = cache.get_or_set(f'a_products:catalog_state:{get_catalog_version()}', compute_catalog_state, CATALOG_STATE_TIMEOUT)
+    return request._catalog_state
+
+def compute_catalog_state():
+    state = Product.objects.aggregate(last_modified=Max('updated_at'), count=Count('id'))
+    return get_digest(state['last_modified'], state['count'], get_taxonomy_version()), state['last_modified']
+
+def get_page_etag(request, *args, **kwargs):
+    catalog_token, last_modified = get_catalog_state(request)
+    # a full page and its htmx partial (or a 'load more' page) are different representations
+    representation = (
+        normalize_filter_params(request.GET, [*FILTER_PARAMS, 'sort', 'cursor']),
+        bool(request.htmx),
+        request.path,
+    )
+    return get_digest(catalog_token, representation)
+
+def get_page_last_modified(request, *args, **kwargs):
+    return get_catalog_state(request)[1]
+
+def catalog_page(view):
+    """
+    Decorate a catalog page view to answer conditional GETs for unchanged pages with a 304,
+    and to serve the other GETs from the shared page cache (see `a_products.page_cache`).
+    """
+    # the Vary header must be on the response before the page cache learns its key, and on 304s too
+    view = vary_on_headers('HX-Request')(view)
+    return vary_on_headers('HX-Request')(condition(etag_func=get_page_etag, last_modified_func=get_page_last_modified)(cache_catalog_page(view)))
@@ -0,0 +1,145 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F
+from django.db.models.functions import Floor
+from .models import Product, FILTER_LOOKUPS, PRICE_LOOKUPS, FILTER_PARAMS
+from .bitmap_index import get_product_index, ids_to_bitset
+from .utils import normalize_filter_params, get_params_cache_key
+from .taxonomy import get_taxonomy
+
+FACET_CACHE_TIMEOUT = 60 * 15  # 15 minutes; entries are also invalidated by the catalog version
+
+# the facets shown in the filter sidebar, in display order
+FACETS = [
+    ('category', 'Category'),
+    ('purpose', 'Purpose'),
+    ('material', 'Material'),
+    ('body_part', 'Body part'),
+]
+
+def filter_with_facets(params):
+    """
+    Filter the products and compute the facet counts for the same filter set.
+
+    :param params: A QueryDict (e.g. request.GET) or a dictionary of filter parameters
+    :return: A tuple (products, counts, params) with the filtered queryset, the counts
+        from `get_facet_counts` and the normalized filter parameters
+    """
+    params = normalize_filter_params(params, FILTER_PARAMS)
+    products = Product.objects.filter_by_params(**params)
+    return products, get_facet_counts(params), params
+
+def get_facet_counts(params):
+    """
+    Return the number of matching products per option of every facet, cached per normalized filter set.
+
+    :param params: A dictionary of filter parameters
+    :return: A dictionary of facet name to a dictionary of option slug to product count
+    """
+    params = normalize_filter_params(params, FILTER_PARAMS)
+    cache_key = get_params_cache_key('a_products:facets', params)
+    counts = cache.get(cache_key)
+    if counts is None:
+        counts = compute_facet_counts(params)
+        cache.set(cache_key, counts, FACET_CACHE_TIMEOUT)
+    return counts
+
+def compute_facet_counts(params):
+    """
+    Compute the facet counts with one grouped query per facet (or from the bitmap index, when enabled).
+
+    The counts of a facet apply all active filters except the facet's own, so that
+    selecting an option doesn't hide the alternatives within the same facet.
+    """
+    index = get_product_index()
+    # the search query and price range aren't in the index; restrict the bitset counts to the products matching them
+    sql_params = {key: values for key, values in params.items() if key not in FILTER_LOOKUPS}
+    if index is not None and sql_params:
+        sql_bits = ids_to_bitset(Product.objects.filter_by_params(**sql_params).order_by().values_list('id', flat=True))
+    counts = {}
+    for facet, lookup in FILTER_LOOKUPS.items():
+        other_params = {key: values for key, values in params.items() if key != facet}
+        if index is not None:
+            # count with bitset intersections instead of grouped queries
+            bits = index.match(other_params)
+            if sql_params:
+                bits = sql_bits if bits is None else bits & sql_bits
+            counts[facet] = index.count(facet, bits)
+            continue
+        rows = (
+            Product.objects.filter_by_params(**other_params)
+            .order_by()
+            .values(lookup)
+            .annotate(count=Count('id', distinct=True))
+            .values_list(lookup, 'count')
+        )
+        counts[facet] = {slug: count for slug, count in rows if slug is not None}
+    return counts
+
+def get_price_histogram(params):
+    """
+    Return the number of matching products per price bucket, cached per normalized filter set.
+
+    :param params: A dictionary of filter parameters
+    :return: A list of buckets (dictionaries with 'min', 'max' and 'count'), in ascending price order
+    """
+    params = normalize_filter_params(params, FILTER_PARAMS)
+    cache_key = get_params_cache_key('a_products:price_histogram', params)
+    histogram = cache.get(cache_key)
+    if histogram is None:
+        histogram = compute_price_histogram(params)
+        cache.set(cache_key, histogram, FACET_CACHE_TIMEOUT)
+    return histogram
+
+def compute_price_histogram(params):
+    """
+    Compute the price histogram with one grouped query.
+
+    Like the facet counts, it applies all active filters except the price range itself,
+    so the slider always shows the whole distribution it can select from.
+    """
+    width = settings.PRODUCT_PRICE_BUCKET_WIDTH
+    other_params = {key: values for key, values in params.items() if key not in PRICE_LOOKUPS}
+    rows = (
+        Product.objects.filter_by_params(**other_params)
+        .order_by()
+        .annotate(bucket=Floor(F('price') / width))
+        .values('bucket')
+        .annotate(count=Count('id'))
+        .values_list('bucket', 'count')
+        .order_by('bucket')
+    )
+    return [{'min': int(bucket) * width, 'max': (int(bucket) + 1) * width, 'count': count} for bucket, count in rows]
+
+def get_price_options(params, histogram):
+    """
+    Prepare the price histogram and the selected range for rendering the price filter.
+    """
+    highest = max((bucket['count'] for bucket in histogram), default=0)
+    price_min = params.get('price_min', ('',))[-1]
+    price_max = params.get('price_max', ('',))[-1]
+    return {
+        'min': histogram[0]['min'] if histogram else 0,
+        'max': histogram[-1]['max'] if histogram else 0,
+        'selected_min': price_min,
+        'selected_max': price_max,
+        'buckets': [{**bucket, 'height': bucket['count'] * 100 // highest} for bucket in histogram],
+    }
+
+def get_facet_options(params, counts):
+    """
+    Combine the taxonomy (from the process-local registry) with the facet counts for rendering the filter sidebar.
+
+    Options without matching products are left out, unless they are selected.
+    """
+    registry = get_taxonomy()
+    facets = []
+    for facet, label in FACETS:
+        selected = params.get(facet, ())
+        options = []
+        for obj in registry.get_options(facet):
+            count = counts[facet].get(obj.slug, 0)
+            if count or obj.slug in selected:
+                options.append({'name': obj.name, 'slug': obj.slug, 'count': count, 'selected': obj.slug in selected})
+        facets.append({'name': facet, 'label': label, 'options': options})
+    return facets
@@ -0,0 +1,108 @@
+"""
+Streaming product feeds (CSV and XML) for comparison sites and marketplaces.
+
+The catalog is walked in chunks of FEED_CHUNK_SIZE products by keyset on the id, with the
+images and taxonomy of each chunk joined or prefetched, so a feed costs a handful of queries
+per chunk and only one chunk is held in memory. The feed is written row by row from a
+generator, so it can be streamed by a `StreamingHttpResponse` or written to a file by the
+`export_products` command, optionally gzip compressed on the fly.
+
+Conditional GETs of an unchanged feed are answered from the catalog state in
+`a_products.conditional`, without building the feed.
+"""
+import csv
+import zlib
+from xml.sax.saxutils import escape
+from .models import Product
+
+FEED_CHUNK_SIZE = 500
+FEED_CURRENCY = 'EUR'
+FEED_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xml': 'application/xml; charset=utf-8',
+}
+FEED_COLUMNS = ['id', 'title', 'description', 'link', 'image_link', 'additional_image_link', 'price', 'product_type', 'material', 'purpose', 'body_parts']
+
+def iter_feed_products(chunk_size=FEED_CHUNK_SIZE):
+    """
+    Iterate over all products in id order, one chunk of products (and their images and taxonomy) at a time.
+    """
+    queryset = (
+        Product.objects.order_by('id')
+        .select_related('category', 'material', 'primary_image', 'secondary_image')
+        .prefetch_related('purpose', 'body_parts')
+    )
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1].pk
+
+def get_feed_item(product, base_url):
+    """
+    :param base_url: The scheme and host to make the links absolute, e.g. 'https://example.com'
+    :return: A dictionary with the FEED_COLUMNS of a product
+    """
+    primary_image = product.get_primary_image()
+    secondary_image = product.get_secondary_image()
+    return {
+        'id': product.pk,
+        'title': product.name,
+        'description': product.description,
+        'link': base_url + product.get_absolute_url(),
+        'image_link': base_url + primary_image.image.url if primary_image else '',
+        'additional_image_link': base_url + secondary_image.image.url if secondary_image else '',
+        'price': f'{product.price} {FEED_CURRENCY}',
+        'product_type': product.category.name if product.category else '',
+        'material': product.material.name if product.material else '',
+        'purpose': ', '.join(purpose.name for purpose in product.purpose.all()),
+        'body_parts': ', '.join(body_part.name for body_part in product.body_parts.all()),
+    }
+
+class _LineBuffer:
+    # a file-like object for csv.writer that hands back each written line instead of storing it
+    def write(self, line):
+        return line
+
+def generate_csv(products, base_url):
+    writer = csv.DictWriter(_LineBuffer(), fieldnames=FEED_COLUMNS)
+    yield writer.writeheader()
+    for product in products:
+        yield writer.writerow(get_feed_item(product, base_url))
+
+def generate_xml(products, base_url):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<products>\n'
+    for product in products:
+        item = get_feed_item(product, base_url)
+        fields = ''.join(f'<{column}>{escape(str(item[column]))}</{column}>' for column in FEED_COLUMNS)
+        yield f'<product>{fields}</product>\n'
+    yield '</products>\n'
+
+FEED_GENERATORS = {
+    'csv': generate_csv,
+    'xml': generate_xml,
+}
+
+def generate_feed(file_format, base_url, compress=False, chunk_size=FEED_CHUNK_SIZE):
+    """
+    Generate a product feed incrementally.
+
+    :param file_format: One of FEED_FORMATS
+    :param compress: Whether to gzip compress the feed
+    :return: An iterator over the feed as chunks of bytes
+    """
+    lines = FEED_GENERATORS[file_format](iter_feed_products(chunk_size), base_url)
+    chunks = (line.encode() for line in lines)
+    return gzip_chunks(chunks) if compress else chunks
+
+def gzip_chunks(chunks):
+    """
+    Gzip compress a stream of bytes, yielding compressed data as it becomes available.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # 16+: with a gzip header and trailer
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
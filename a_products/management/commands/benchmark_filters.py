@@ -0,0 +1,116 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from a_products.models import Product, Category, Purpose, Material, BodyPart
+from a_products.bitmap_index import product_index
+from a_products import search
+
+FILTER_SETS = [
+    {'category': ['category-1']},
+    {'category': ['category-1', 'category-2'], 'material': ['material-3']},
+    {'purpose': ['purpose-1', 'purpose-4']},
+    {'category': ['category-5'], 'purpose': ['purpose-2'], 'body_part': ['body-part-1', 'body-part-2']},
+    {'category': ['category-3', 'category-7'], 'material': ['material-1', 'material-2'], 'purpose': ['purpose-3'], 'body_part': ['body-part-4']},
+]
+
+SEARCHES = [
+    {'q': 'velvet'},
+    {'q': 'soft leath'},
+    {'q': 'adjustable strap', 'category': ['category-2']},
+]
+
+WORDS = (
+    "soft leather silicone velvet adjustable strap buckle rope cotton smooth firm black red "
+    "handmade durable washable steel ring padded lined stretch satin lace elegant classic"
+).split()
+
+class Command(BaseCommand):
+    help = "Compare the SQL and bitmap index paths of filter_by_params on a synthetic catalog (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=50000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.seed(options['products'])
+
+            start = time.perf_counter()
+            product_index.build()
+            self.stdout.write(f"Index build: {(time.perf_counter() - start) * 1000:.1f} ms for {options['products']} products")
+            self.stdout.write(f"{'filters':<110} {'matches':>8} {'sql ms':>8} {'index ms':>9}")
+
+            for params in FILTER_SETS:
+                with override_settings(PRODUCT_BITMAP_INDEX=False):
+                    sql_ms, matches = self.measure(params, options['repeat'])
+                with override_settings(PRODUCT_BITMAP_INDEX=True):
+                    index_ms, index_matches = self.measure(params, options['repeat'])
+                if matches != index_matches:
+                    self.stderr.write(f"Result mismatch for {params}: {matches} != {index_matches}")
+                self.stdout.write(f"{str(params):<110} {matches:>8} {sql_ms:>8.1f} {index_ms:>9.1f}")
+
+            start = time.perf_counter()
+            search.rebuild()
+            self.stdout.write(f"Search index rebuild: {(time.perf_counter() - start) * 1000:.1f} ms")
+            for params in SEARCHES:
+                search_ms, matches = self.measure(params, options['repeat'])
+                self.stdout.write(f"{str(params):<110} {matches:>8} {search_ms:>8.1f}")
+
+            transaction.set_rollback(True)
+        product_index.is_built = False
+
+    def measure(self, params, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            products = list(Product.objects.filter_by_params(**params))
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings), len(set(p.id for p in products))
+
+    def seed(self, count):
+        rng = random.Random(42)
+        # long descriptions: a few meaningful words mixed into a larger synthetic vocabulary
+        vocabulary = WORDS + [f"term{i}" for i in range(5000)]
+        taxonomy = {}
+        for model, prefix, size in ((Category, 'category', 10), (Purpose, 'purpose', 8), (Material, 'material', 6), (BodyPart, 'body-part', 6)):
+            model.objects.bulk_create(
+                [model(name=f"{prefix} {i}", slug=f"{prefix}-{i}") for i in range(1, size + 1)],
+                ignore_conflicts=True,
+            )
+            taxonomy[model] = list(model.objects.filter(slug__startswith=f"{prefix}-").values_list('id', flat=True))
+
+        products = Product.objects.bulk_create(
+            [
+                Product(
+                    name=f"Benchmark product {i} {' '.join(rng.sample(WORDS, 2))}",
+                    description=' '.join(rng.choices(vocabulary, k=300)),
+                    slug=f"benchmark-product-{i}",
+                    price=rng.randint(100, 20000) / 100,
+                    category_id=rng.choice(taxonomy[Category]),
+                    material_id=rng.choice(taxonomy[Material]),
+                )
+                for i in range(count)
+            ],
+            batch_size=2000,
+        )
+        product_ids = [product.id for product in products]
+
+        Product.purpose.through.objects.bulk_create(
+            [
+                Product.purpose.through(product_id=product_id, purpose_id=purpose_id)
+                for product_id in product_ids
+                for purpose_id in rng.sample(taxonomy[Purpose], 2)
+            ],
+            batch_size=5000,
+        )
+        Product.body_parts.through.objects.bulk_create(
+            [
+                Product.body_parts.through(product_id=product_id, bodypart_id=body_part_id)
+                for product_id in product_ids
+                for body_part_id in rng.sample(taxonomy[BodyPart], 2)
+            ],
+            batch_size=5000,
+        )
@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+from a_products.feeds import FEED_CHUNK_SIZE, FEED_FORMATS, generate_feed
+
+class Command(BaseCommand):
+    help = "Write the product feed (CSV or XML, optionally gzip compressed) to a file or stdout, streaming the catalog in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The file to write, or '-' for stdout; a '.gz' extension compresses the feed")
+        parser.add_argument('--format', choices=list(FEED_FORMATS), help="Defaults to the file extension")
+        parser.add_argument('--base-url', help="The scheme and host of the product links (defaults to https:// and the current site's domain)")
+        parser.add_argument('--chunk-size', type=int, default=FEED_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        compress = path.endswith('.gz')
+        file_format = options['format'] or ('xml' if path.removesuffix('.gz').endswith('.xml') else 'csv')
+        base_url = (options['base_url'] or f'https://{Site.objects.get_current().domain}').rstrip('/')
+        chunks = generate_feed(file_format, base_url, compress=compress, chunk_size=options['chunk_size'])
+
+        start = time.perf_counter()
+        size = 0
+        if path == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+
+        # write next to the target and swap it in, so a feed being served is never half written
+        temporary_path = f'{path}.tmp'
+        try:
+            with open(temporary_path, 'wb') as file:
+                for chunk in chunks:
+                    size += file.write(chunk)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {size} bytes to {path} in {time.perf_counter() - start:.1f}s"))
@@ -0,0 +1,170 @@
+import csv
+import json
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+from a_products.models import Product, Category, Purpose, Material, BodyPart, generate_product_slugs
+from a_products.utils import bump_catalog_version
+from a_products.slugs import invalidate_slugs
+from a_products import search
+
+# column -> (taxonomy model, Product field); M2M columns hold several values, separated by '|' in CSV files
+TAXONOMY_COLUMNS = {
+    'category': (Category, 'category'),
+    'material': (Material, 'material'),
+    'purpose': (Purpose, 'purpose'),
+    'body_parts': (BodyPart, 'body_parts'),
+}
+UPDATE_FIELDS = ['description', 'price', 'category', 'material', 'updated_at']
+PROGRESS_EVERY = 100000  # rows
+
+class Command(BaseCommand):
+    help = "Create or update products in bulk from a CSV or JSON Lines file (columns: name, price, description, category, material, purpose, body_parts)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The file to import, or '-' for stdin")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--create-taxonomy', action='store_true', help="Create unknown categories, materials, purposes and body parts")
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or ('jsonl' if options['path'].endswith(('.jsonl', '.ndjson')) else 'csv')
+        self.create_taxonomy = options['create_taxonomy']
+        # slug -> id of every taxonomy option; small enough to keep in memory
+        self.taxonomy = {column: dict(model.objects.values_list('slug', 'id')) for column, (model, _) in TAXONOMY_COLUMNS.items()}
+        self.stats = {'rows': 0, 'created': 0, 'updated': 0, 'skipped': 0}
+        self.next_report = PROGRESS_EVERY
+
+        start = time.perf_counter()
+        file = sys.stdin if options['path'] == '-' else open(options['path'], newline='', encoding='utf-8')
+        try:
+            rows = self.read_rows(file, file_format)
+            # only one batch of rows is held in memory at a time
+            while batch := list(islice(rows, options['batch_size'])):
+                with transaction.atomic():
+                    self.import_batch(batch)
+                self.report_progress(start)
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+        # bulk writes bypass the signals that keep the search index and the catalog caches up to date
+        if search.is_available():
+            search.rebuild()
+        bump_catalog_version()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {self.stats['rows']} rows in {elapsed:.1f}s ({self.stats['rows'] / max(elapsed, 1e-9):.0f} rows/s): "
+            f"{self.stats['created']} created, {self.stats['updated']} updated, {self.stats['skipped']} skipped"
+        ))
+
+    def read_rows(self, file, file_format):
+        if file_format == 'csv':
+            for row in csv.DictReader(file):
+                for column in ('purpose', 'body_parts'):
+                    if column in row:
+                        row[column] = [value for value in (row[column] or '').split('|') if value.strip()]
+                yield row
+        else:
+            for line_number, line in enumerate(file, 1):
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError as error:
+                        raise CommandError(f"Line {line_number}: {error}")
+
+    def import_batch(self, rows):
+        rows = [row for row in map(self.clean_row, rows) if row is not None]
+        # later rows for the same product win
+        rows = list({row['name']: row for row in rows}.values())
+
+        # products are identified by name; their slugs may carry a suffix from an earlier collision
+        existing = {product.name: product for product in Product.objects.filter(name__in=[row['name'] for row in rows])}
+        new_rows = [row for row in rows if row['name'] not in existing]
+        slugs = generate_product_slugs([row['name'] for row in new_rows])
+
+        now = timezone.now()
+        to_create = []
+        to_update = []
+        for row in rows:
+            product = existing.get(row['name']) or Product(name=row['name'], slug=slugs[row['name']])
+            product.price = row['price']
+            product.description = row.get('description') or ''
+            product.category_id = self.resolve(row, 'category')
+            product.material_id = self.resolve(row, 'material')
+            product.updated_at = now  # bulk_update skips auto_now
+            (to_update if product.pk else to_create).append(product)
+            row['product'] = product
+
+        Product.objects.bulk_create(to_create)
+        Product.objects.bulk_update(to_update, UPDATE_FIELDS)
+        invalidate_slugs([product.slug for product in to_update])
+        self.stats['created'] += len(to_create)
+        self.stats['updated'] += len(to_update)
+
+        for column in ('purpose', 'body_parts'):
+            self.import_m2m(rows, column)
+
+    def clean_row(self, row):
+        self.stats['rows'] += 1
+        name = (row.get('name') or '').strip()
+        try:
+            price = Decimal(str(row.get('price')).strip())
+        except (InvalidOperation, ValueError):
+            price = None
+        if not name or not slugify(name) or price is None or not price.is_finite():
+            self.stats['skipped'] += 1
+            self.stderr.write(f"Row {self.stats['rows']}: a name and a valid price are required")
+            return None
+        row['name'] = name
+        row['price'] = price
+        return row
+
+    def resolve(self, row, column):
+        """
+        :return: The id of the taxonomy option named in a row's column, or None
+        """
+        value = row.get(column)
+        return self.resolve_value(column, value) if value else None
+
+    def resolve_value(self, column, value):
+        slug = slugify(value)
+        option_id = self.taxonomy[column].get(slug)
+        if option_id is None and self.create_taxonomy and slug:
+            model = TAXONOMY_COLUMNS[column][0]
+            option_id = self.taxonomy[column][slug] = model.objects.create(name=value.strip()).pk
+        elif option_id is None:
+            self.stderr.write(f"Unknown {column} '{value}' (use --create-taxonomy to create it)")
+        return option_id
+
+    def import_m2m(self, rows, column):
+        """
+        Replace the M2M options of the products whose rows have the column, with bulk deletes and inserts of through rows.
+        """
+        rows = [row for row in rows if column in row]
+        if not rows:
+            return
+        field = Product._meta.get_field(TAXONOMY_COLUMNS[column][1])
+        through = field.remote_field.through
+        product_column = f'{field.m2m_field_name()}_id'
+        option_column = f'{field.m2m_reverse_field_name()}_id'
+
+        through.objects.filter(**{f'{product_column}__in': [row['product'].pk for row in rows]}).delete()
+        through_rows = []
+        for row in rows:
+            values = row[column] if isinstance(row[column], list) else [row[column]]
+            option_ids = {self.resolve_value(column, value) for value in values}
+            through_rows += [through(**{product_column: row['product'].pk, option_column: option_id}) for option_id in option_ids if option_id]
+        through.objects.bulk_create(through_rows, ignore_conflicts=True)
+
+    def report_progress(self, start):
+        if self.stats['rows'] >= self.next_report:
+            self.next_report += PROGRESS_EVERY
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f"{self.stats['rows']} rows ({self.stats['rows'] / elapsed:.0f} rows/s)")
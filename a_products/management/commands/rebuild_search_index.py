@@ -0,0 +1,16 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from a_products import search
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text product search index from the products table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if not search.is_available(options['database']):
+            raise CommandError("Full-text search requires SQLite (FTS5)")
+        start = time.perf_counter()
+        search.rebuild(using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the search index in {time.perf_counter() - start:.2f}s"))
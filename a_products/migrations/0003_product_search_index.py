@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite specific; other databases fall back to icontains searches
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE a_products_product_fts USING fts5("
+        "name, description, content='a_products_product', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    # rank matches in the name higher than matches in the description
+    schema_editor.execute("INSERT INTO a_products_product_fts (a_products_product_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+    schema_editor.execute("INSERT INTO a_products_product_fts (a_products_product_fts) VALUES ('rebuild')")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS a_products_product_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_products', '0002_productimage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.7 on 2026-10-18 14:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_image_pointers(apps, schema_editor):
+    Product = apps.get_model('a_products', 'Product')
+    ProductImage = apps.get_model('a_products', 'ProductImage')
+    for flag, pointer in (('is_primary', 'primary_image'), ('is_secondary', 'secondary_image')):
+        # the first flagged image, as the flags were read before
+        flagged = ProductImage.objects.filter(product=models.OuterRef('pk'), **{flag: True}).order_by('order', 'created_at')
+        Product.objects.update(**{pointer: models.Subquery(flagged.values('pk')[:1])})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_products', '0005_productimage_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='primary_image',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='a_products.productimage'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='secondary_image',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='a_products.productimage'),
+        ),
+        migrations.RunPython(backfill_image_pointers, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,11 @@
-from django.db import models
-from django.db.models import Q
+import re
+from decimal import Decimal, InvalidOperation
+from django.db import models, transaction
+from django.db.models import Q, Exists, OuterRef
 from django.utils.text import slugify
 from django.urls import reverse
+from a_core.images import get_picture_sources, get_placeholder
+from . import search as fts
 
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -51,6 +55,30 @@ class BodyPart(models.Model):
         super().save(*args, **kwargs)
     
 
+# maps each filter parameter to the lookup of the slug it filters on
+FILTER_LOOKUPS = {
+    'category': 'category__slug',
+    'purpose': 'purpose__slug',
+    'material': 'material__slug',
+    'body_part': 'body_parts__slug',
+}
+# maps the price range parameters to their lookup on Product.price
+PRICE_LOOKUPS = {
+    'price_min': 'price__gte',
+    'price_max': 'price__lte',
+}
+# all parameters understood by `filter_by_params`; 'q' is a full-text search query
+FILTER_PARAMS = [*FILTER_LOOKUPS, *PRICE_LOOKUPS, 'q']
+
+# sort options of the product listing; each ends with 'id' so it's unique (as keyset pagination needs),
+# and each has a matching composite index in Product.Meta
+SORT_OPTIONS = {
+    'price': ('price', 'id'),
+    '-price': ('-price', '-id'),
+    'newest': ('-created_at', '-id'),
+    'name': ('name', 'id'),
+}
+
 class ProductQuerySet(models.QuerySet):
     def filter_by_params(self, **params):
         """
@@ -59,25 +87,105 @@ class ProductQuerySet(models.QuerySet):
         :param params: A dictionary of filter parameters
         :return: A filtered queryset
         """
+        params = dict(params)
+        query = params.pop('q', None)
+        if isinstance(query, (list, tuple)):
+            query = ' '.join(query)
+        price_conditions = self._get_price_conditions({key: params.pop(key) for key in PRICE_LOOKUPS if key in params})
+
+        # drop unknown slugs; a facet filter without any known slug can't match any product
+        from .taxonomy import get_taxonomy
+        registry = get_taxonomy()
+        for key in FILTER_LOOKUPS.keys() & params.keys():
+            values = params[key] if isinstance(params[key], (list, tuple)) else [params[key]]
+            params[key] = registry.clean_slugs(key, values)
+            if not params[key]:
+                return self.none()
+
+        # answer the filters from the in-process bitmap index when it's enabled (see PRODUCT_BITMAP_INDEX)
+        from .bitmap_index import get_product_index
+        index = get_product_index()
+        if index is not None:
+            queryset = index.filter(self, params)
+        else:
+            queryset = self.filter(self._get_filter_conditions(params))
+
+        if price_conditions:
+            queryset = queryset.filter(price_conditions)
+        if query:
+            queryset = queryset.search(query)
+        return queryset
+
+    def _get_filter_conditions(self, params):
         filters = Q()
         for key, values in params.items():
-            if not isinstance(values, list):
+            if key not in FILTER_LOOKUPS:
+                continue
+            if not isinstance(values, (list, tuple)):
                 values = [values]  # Convert single values to a list
-            
-            q_objects = Q()
-            for value in values:
-                if key == 'category':
-                    q_objects |= Q(category__slug=value)
-                elif key == 'purpose':
-                    q_objects |= Q(purpose__slug=value)
-                elif key == 'material':
-                    q_objects |= Q(material__slug=value)
-                elif key == 'body_part':
-                    q_objects |= Q(body_parts__slug=value)
-            
-            filters &= q_objects
+
+            field_name, _, slug_lookup = FILTER_LOOKUPS[key].partition('__')
+            field = self.model._meta.get_field(field_name)
+            if field.many_to_many:
+                # evaluate M2M facets as a semi-join on the through table, so each product is returned once
+                # no matter how many of the selected values it has (a join would duplicate it)
+                through_rows = field.remote_field.through.objects.filter(**{
+                    field.m2m_field_name(): OuterRef('pk'),
+                    f'{field.m2m_reverse_field_name()}__{slug_lookup}__in': values,
+                })
+                filters &= Q(Exists(through_rows))
+            else:
+                filters &= Q(**{f'{FILTER_LOOKUPS[key]}__in': values})
         
-        return self.filter(filters)
+        return filters
+
+    def _get_price_conditions(self, params):
+        filters = Q()
+        for key, value in params.items():
+            if isinstance(value, (list, tuple)):
+                value = value[-1] if value else None
+            try:
+                price = Decimal(str(value))
+            except (InvalidOperation, ValueError):
+                continue  # ignore malformed prices rather than failing the whole listing
+            if price.is_finite():
+                filters &= Q(**{PRICE_LOOKUPS[key]: price})
+        return filters
+
+    def search(self, query):
+        """
+        Full-text search on the name and description, ordered by relevance (best matches first).
+
+        :param query: Free user input; every word has to match (as a prefix)
+        :return: A filtered queryset annotated with `search_rank` (lower is better)
+        """
+        match = fts.build_match_query(query)
+        if match is None:
+            return self
+        if not fts.is_available(self.db):
+            return self.filter(Q(name__icontains=query) | Q(description__icontains=query))
+
+        # join the FTS table directly (rather than a correlated rank subquery per product), so SQLite
+        # drives the query from the full-text match and looks the products up by primary key
+        table = fts.SEARCH_TABLE
+        return self.extra(
+            select={'search_rank': f'{table}.rank'},
+            tables=[table],
+            where=[f'{table}.rowid = {self.model._meta.db_table}.id', f'{table} MATCH %s'],
+            params=[match],
+        ).order_by('search_rank', 'id')
+
+    def with_card_images(self):
+        """
+        Load the primary and secondary images needed to render product cards, joined into the product query.
+        """
+        return self.select_related('primary_image', 'secondary_image')
+
+    def with_images(self):
+        """
+        Batch-load all images of the products (e.g. for the carousel on the detail page).
+        """
+        return self.prefetch_related('images')
 
 class Product(models.Model):
     name = models.CharField(max_length=200)
@@ -88,27 +196,113 @@ class Product(models.Model):
     purpose = models.ManyToManyField(Purpose, blank=True)
     material = models.ForeignKey(Material, on_delete=models.SET_NULL, null=True, blank=True)
     body_parts = models.ManyToManyField(BodyPart, blank=True)
+    # denormalized pointers to the images flagged primary and secondary, maintained by ProductImage.save
+    primary_image = models.ForeignKey('ProductImage', on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+')
+    secondary_image = models.ForeignKey('ProductImage', on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+')
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     objects = ProductQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            # the SORT_OPTIONS, on their own and within a category or material filter
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+            models.Index(fields=['created_at', 'id'], name='product_created_idx'),
+            models.Index(fields=['name', 'id'], name='product_name_idx'),
+            models.Index(fields=['category', 'price', 'id'], name='product_category_price_idx'),
+            models.Index(fields=['category', 'created_at', 'id'], name='product_category_created_idx'),
+            models.Index(fields=['category', 'name', 'id'], name='product_category_name_idx'),
+            models.Index(fields=['material', 'price', 'id'], name='product_material_price_idx'),
+        ]
+
     def __str__(self):
         return self.name
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # the stored name, to tell whether saving renames the product (see save)
+        instance._stored_name = values[field_names.index('name')] if 'name' in field_names else None
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        if fields is None or 'name' in fields:
+            self._stored_name = self.name
+
     def save(self, *args, **kwargs):
-        self.slug = slugify(self.name)
+        # the slug follows the name; a numeric suffix given to avoid a collision (see generate_product_slugs)
+        # is kept only as long as the name's slug doesn't change
+        if self.slug_needs_update():
+            self.slug = generate_product_slugs([self.name], exclude_pk=self.pk)[self.name]
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            # the image pointers are maintained by ProductImage.save; don't overwrite them from a stale instance
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ('primary_image', 'secondary_image')
+            ]
         super().save(*args, **kwargs)
+        self._stored_name = self.name
+
+    def slug_needs_update(self):
+        base = slugify(self.name)
+        if not re.fullmatch(rf'{re.escape(base)}(-\d+)?', self.slug or ''):
+            return True
+        if self._state.adding:
+            return False  # a new product with a slug generated for it (e.g. by import_products)
+        stored_name = getattr(self, '_stored_name', None)
+        if stored_name is None:
+            stored_name = Product.objects.filter(pk=self.pk).values_list('name', flat=True).first() or ''
+        # e.g. renaming 'Plug 2' (slug 'plug-2') to 'Plug' must not keep 'plug-2' as if it were a suffix
+        return slugify(stored_name) != base
 
     def get_absolute_url(self):
         return reverse("products:view_product", kwargs={"slug": self.slug})
 
     def get_primary_image(self):
-        return self.images.filter(is_primary=True).first()
+        return self._get_pointed_image('primary_image')
 
     def get_secondary_image(self):
-        return self.images.filter(is_secondary=True).first()
+        return self._get_pointed_image('secondary_image')
+
+    def _get_pointed_image(self, field_name):
+        # prefer the images loaded by `with_card_images` or `with_images`; only query when nothing was loaded
+        image_id = getattr(self, f'{field_name}_id')
+        if image_id is None:
+            return None
+        if not self._meta.get_field(field_name).is_cached(self) and 'images' in getattr(self, '_prefetched_objects_cache', {}):
+            return next((image for image in self.images.all() if image.pk == image_id), None)
+        return getattr(self, field_name)
+
+def generate_product_slugs(names, exclude_pk=None):
+    """
+    Generate unique slugs for products, numbering slugs that are taken (by the database or the batch).
+
+    :param names: The product names
+    :param exclude_pk: A product whose own slug doesn't count as taken (when it's renamed)
+    :return: A dictionary of name to slug
+    """
+    products = Product.objects.exclude(pk=exclude_pk) if exclude_pk is not None else Product.objects.all()
+    bases = {name: slugify(name) for name in names}
+    taken = set(products.filter(slug__in=set(bases.values())).values_list('slug', flat=True))
+    probed = set()
+    slugs = {}
+    for name, base in bases.items():
+        slug = base
+        if slug in taken:
+            if base not in probed:
+                # one query per colliding base, to learn its numbered slugs
+                taken.update(products.filter(slug__startswith=f'{base}-').values_list('slug', flat=True))
+                probed.add(base)
+            number = 2
+            while f'{base}-{number}' in taken:
+                number += 1
+            slug = f'{base}-{number}'
+        taken.add(slug)
+        slugs[name] = slug
+    return slugs
 
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, related_name='images', on_delete=models.CASCADE)
@@ -117,6 +311,8 @@ class ProductImage(models.Model):
     is_primary = models.BooleanField(default=False)
     is_secondary = models.BooleanField(default=False)
     order = models.PositiveIntegerField(default=0, help_text="Order of appearance")
+    # resized copies in modern formats, generated after upload (see a_core.images)
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -129,16 +325,39 @@ class ProductImage(models.Model):
 
     def save(self, *args, **kwargs):
         if self.is_primary:
-            # Ensure only one primary image per product
-            ProductImage.objects.filter(product=self.product, is_primary=True).update(is_primary=False)
             self.is_secondary = False
-        if self.is_secondary:
-            # Ensure only one secondary image per product
-            ProductImage.objects.filter(product=self.product, is_secondary=True).update(is_secondary=False)
-            self.is_primary = False
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._update_product_pointers()
+
+    def _update_product_pointers(self):
+        """
+        Point the product at this image if it's flagged primary or secondary (unflagging the image pointed at
+        before, to ensure one primary and one secondary image per product), or clear the pointer if it no longer is.
+        """
+        pointers = Product.objects.select_for_update().filter(pk=self.product_id).values('primary_image_id', 'secondary_image_id').get()
+        changes = {}
+        for flag, pointer in (('is_primary', 'primary_image_id'), ('is_secondary', 'secondary_image_id')):
+            current_id = pointers[pointer]
+            if getattr(self, flag) and current_id != self.pk:
+                if current_id is not None:
+                    ProductImage.objects.filter(pk=current_id).update(**{flag: False})
+                changes[pointer] = self.pk
+            elif not getattr(self, flag) and current_id == self.pk:
+                changes[pointer] = None
+        if changes:
+            Product.objects.filter(pk=self.product_id).update(**changes)
+            if ProductImage.product.is_cached(self):
+                for pointer, image_id in changes.items():
+                    setattr(self.product, pointer, image_id)
 
     @property
     def get_url(self):
         return self.image.url if self.image else None
+
+    def get_sources(self):
+        return get_picture_sources(self.image, self.derivatives)
+
+    def get_placeholder(self):
+        return get_placeholder(self.image, self.derivatives)
     
\ No newline at end of file
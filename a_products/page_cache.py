@@ -0,0 +1,50 @@
+"""
+Shared full-page cache for the catalog pages.
+
+The catalog pages hold no per-visitor data (the cart and user menus are loaded separately,
+from `cart:navbar_menus`), so one rendered page can be served to every visitor. Pages are
+cached like Django's cache middleware does: under their URL and the request headers the
+response varies on (e.g. HX-Request, for the htmx partials). The keys are scoped to the
+catalog version, so any catalog change starts a fresh set of pages.
+
+Responses that did turn out per-visitor, because the view touched the session, used a
+CSRF token or set a cookie, are never cached.
+"""
+from functools import wraps
+from django.core.cache import cache
+from django.utils.cache import get_cache_key, learn_cache_key
+from .utils import get_catalog_version
+
+PAGE_CACHE_TIMEOUT = 60 * 15  # 15 minutes; entries are also invalidated by the catalog version
+
+def cache_catalog_page(view):
+    """
+    Decorate a view to serve its GET responses from the shared page cache.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view(request, *args, **kwargs)
+
+        key_prefix = f'a_products:page:{get_catalog_version()}'
+        cache_key = get_cache_key(request, key_prefix, 'GET', cache=cache)
+        response = cache.get(cache_key) if cache_key else None
+        if response is not None:
+            return response
+
+        response = view(request, *args, **kwargs)
+        if is_shared_response(request, response):
+            cache.set(learn_cache_key(request, response, PAGE_CACHE_TIMEOUT, key_prefix, cache=cache), response, PAGE_CACHE_TIMEOUT)
+        return response
+    return wrapper
+
+def is_shared_response(request, response):
+    session = getattr(request, 'session', None)
+    return (
+        response.status_code == 200
+        and not response.streaming
+        and not response.cookies
+        and not (session is not None and session.accessed)
+        and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')
+        and 'private' not in response.get('Cache-Control', '')
+    )
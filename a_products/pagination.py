@@ -0,0 +1,110 @@
+"""
+Keyset (cursor) pagination for product listings.
+
+Instead of an OFFSET, which makes the database walk past every earlier row, the next page
+starts right after the sort key of the last product on the current page. The sort key must
+be unique (e.g. end with 'id'), so that pages never overlap or skip products, and the cost of
+fetching a page stays the same at any depth.
+"""
+from decimal import Decimal
+from django.core import signing
+from django.db import connections
+from django.db.models import Q
+
+PAGE_SIZE = 24
+CURSOR_SALT = 'a_products.pagination.cursor'
+
+def get_page(queryset, ordering, cursor=None, page_size=PAGE_SIZE):
+    """
+    Fetch one page of a queryset.
+
+    :param queryset: The (filtered) queryset to paginate
+    :param ordering: A unique sort key, as a sequence of field names ('-' prefix for descending);
+        extra selects (like `search_rank`) are supported too
+    :param cursor: The cursor returned for the previous page, or None for the first page
+    :param page_size: The number of items per page
+    :return: A tuple (items, next_cursor) where next_cursor is None on the last page
+    """
+    queryset = queryset.order_by(*ordering)
+    values = decode_cursor(cursor, ordering) if cursor else None
+    if values is not None:
+        queryset = after_keyset(queryset, ordering, values)
+
+    # fetch one item more than needed, to know whether there is a next page
+    items = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(ordering, [getattr(items[-1], key.lstrip('-')) for key in ordering])
+    return items, next_cursor
+
+def after_keyset(queryset, ordering, values):
+    """
+    Filter a queryset to the rows sorting after the given sort key values.
+
+    For ordering (a, b) this is: a >= x AND (a > x OR (a = x AND b > y)), with < for descending keys.
+    The leading a >= x is redundant, but lets the database seek the index to the cursor instead of
+    scanning it from the start.
+    """
+    keys = [(key.lstrip('-'), key.startswith('-')) for key in ordering]
+    if any(name in queryset.query.extra_select for name, descending in keys):
+        return _after_keyset_sql(queryset, keys, values)
+
+    condition = Q()
+    for i, (name, descending) in enumerate(keys):
+        step = Q(**{f"{name}__{'lt' if descending else 'gt'}": values[i]})
+        for j, (previous_name, _) in enumerate(keys[:i]):
+            step &= Q(**{previous_name: values[j]})
+        condition |= step
+    # the OR alone can't be used to seek an index; the redundant bound on the leading key can
+    name, descending = keys[0]
+    return queryset.filter(Q(**{f"{name}__{'lte' if descending else 'gte'}": values[0]}) & condition)
+
+def _after_keyset_sql(queryset, keys, values):
+    # extra selects can't be used in filter(), so build the same condition in SQL
+    quote_name = connections[queryset.db].ops.quote_name
+    table = queryset.model._meta.db_table
+
+    def column(name):
+        if name in queryset.query.extra_select:
+            return f'({queryset.query.extra_select[name][0]})', list(queryset.query.extra_select[name][1])
+        field = queryset.model._meta.get_field(name)
+        return f'{quote_name(table)}.{quote_name(field.column)}', []
+
+    conditions = []
+    params = []
+    for i, (name, descending) in enumerate(keys):
+        parts = []
+        for j, (previous_name, _) in enumerate(keys[:i]):
+            sql, sql_params = column(previous_name)
+            parts.append(f'{sql} = %s')
+            params += sql_params + [values[j]]
+        sql, sql_params = column(name)
+        parts.append(f"{sql} {'<' if descending else '>'} %s")
+        params += sql_params + [values[i]]
+        conditions.append('(' + ' AND '.join(parts) + ')')
+    # the same redundant bound on the leading key as in after_keyset, to seek rather than scan
+    name, descending = keys[0]
+    sql, sql_params = column(name)
+    where = f"{sql} {'<=' if descending else '>='} %s AND (" + ' OR '.join(conditions) + ')'
+    return queryset.extra(where=[where], params=sql_params + [values[0]] + params)
+
+def encode_cursor(ordering, values):
+    # sign the ordering into the cursor, so it can't be replayed against another sort key
+    values = [value.isoformat() if hasattr(value, 'isoformat') else str(value) if isinstance(value, Decimal) else value for value in values]
+    return signing.dumps([list(ordering), values], salt=CURSOR_SALT, compress=True)
+
+def decode_cursor(cursor, ordering):
+    """
+    :return: The sort key values of the cursor, or None if it's invalid (e.g. tampered with or for another ordering)
+    """
+    try:
+        payload = signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        return None
+    if not isinstance(payload, list) or len(payload) != 2:
+        return None
+    cursor_ordering, values = payload
+    if cursor_ordering != list(ordering) or not isinstance(values, list) or len(values) != len(ordering):
+        return None
+    return values
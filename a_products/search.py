@@ -0,0 +1,56 @@
+"""
+Full-text product search backed by an SQLite FTS5 index.
+
+The index is an external content FTS5 table over the name and description of the products
+(created in migration 0003), so long descriptions aren't stored twice. It's kept in sync by
+the signals in `a_products.signals` and can be rebuilt with `manage.py rebuild_search_index`.
+Databases other than SQLite fall back to a (slow) icontains search.
+"""
+import re
+from django.db import connections
+
+SEARCH_TABLE = 'a_products_product_fts'
+PRODUCT_TABLE = 'a_products_product'
+
+def is_available(using='default'):
+    return connections[using].vendor == 'sqlite'
+
+def build_match_query(query):
+    """
+    Turn free user input into a safe FTS5 query: every word must match, as a prefix.
+
+    :return: The MATCH expression, or None if the input has no searchable words
+    """
+    words = re.findall(r'\w+', query or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+def update_product(product_id, name, description, using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, name, description) VALUES (%s, %s, %s)',
+            [product_id, name, description],
+        )
+
+def remove_product(product_id, using='default'):
+    """
+    Remove a product from the index, based on the values currently stored for it in the products table.
+
+    External content tables need the indexed values to delete an entry, so this must run
+    before the product row is changed or deleted.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, name, description) "
+            f"SELECT 'delete', id, name, description FROM {PRODUCT_TABLE} WHERE id = %s",
+            [product_id],
+        )
+
+def rebuild(using='default'):
+    """
+    Rebuild the whole index from the products table, e.g. after bulk updates that bypass signals.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
@@ -0,0 +1,156 @@
+import threading
+from functools import partial
+from django.db import transaction
+from django.utils import timezone
+from a_core.images import needs_derivatives, schedule_derivatives
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from .models import Product, ProductImage, Category, Purpose, Material, BodyPart
+from .bitmap_index import product_index, FACET_FIELDS
+from . import search, slugs
+from .utils import bump_catalog_version, get_catalog_version
+from .taxonomy import TAXONOMY_MODELS, bump_taxonomy_version
+
+TAXONOMY_FACETS = {model: facet for facet, (model, field_name) in FACET_FIELDS.items()}
+
+# the catalog version the bitmap index will reflect once this thread's queued changes are committed
+_index_changes = threading.local()
+
+def invalidate_catalog_caches(sender, action=None, **kwargs):
+    """
+    Signal to invalidate everything cached per catalog version (e.g. facet counts) when products, their images or the taxonomy change.
+    """
+    # m2m_changed fires before and after the change; only react once it happened
+    if action is None or action.startswith('post_'):
+        version = get_catalog_version()
+        index_is_tracked = product_index.is_built and version in (product_index.version, getattr(_index_changes, 'version', None))
+        new_version = bump_catalog_version()
+        # the index handlers below queue this change until commit; a rolled back change leaves the index
+        # behind the catalog version, so it's rebuilt on next use instead
+        _index_changes.version = new_version if index_is_tracked else None
+        if index_is_tracked:
+            transaction.on_commit(partial(product_index.mark_current, new_version))
+
+for model in (Product, ProductImage, Category, Purpose, Material, BodyPart):
+    post_save.connect(invalidate_catalog_caches, sender=model)
+    post_delete.connect(invalidate_catalog_caches, sender=model)
+
+for through in (Product.purpose.through, Product.body_parts.through):
+    m2m_changed.connect(invalidate_catalog_caches, sender=through)
+
+def invalidate_taxonomy(sender, **kwargs):
+    """
+    Signal to make every process reload its taxonomy registry.
+    """
+    bump_taxonomy_version()
+
+for model in TAXONOMY_MODELS.values():
+    post_save.connect(invalidate_taxonomy, sender=model)
+    post_delete.connect(invalidate_taxonomy, sender=model)
+
+
+# Incremental updates of the bitmap index (connected after `invalidate_catalog_caches`, which decides whether the index tracks the change)
+
+def index_is_tracked():
+    return getattr(_index_changes, 'version', None) == get_catalog_version()
+
+def update_index_on_commit(update, *args):
+    # the index is process-global, so it must not see changes of a transaction that may still roll back
+    transaction.on_commit(partial(update, *args))
+
+def index_product(sender, instance, **kwargs):
+    if index_is_tracked():
+        update_index_on_commit(product_index.set_product_option, 'category', instance.pk, instance.category_id)
+        update_index_on_commit(product_index.set_product_option, 'material', instance.pk, instance.material_id)
+
+def unindex_product(sender, instance, **kwargs):
+    if index_is_tracked():
+        update_index_on_commit(product_index.remove_product, instance.pk)
+
+def index_taxonomy(sender, instance, **kwargs):
+    if index_is_tracked():
+        update_index_on_commit(product_index.set_option_slug, TAXONOMY_FACETS[sender], instance.pk, instance.slug)
+
+def unindex_taxonomy(sender, instance, **kwargs):
+    if index_is_tracked():
+        update_index_on_commit(product_index.remove_option, TAXONOMY_FACETS[sender], instance.pk)
+
+def index_product_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear') or not index_is_tracked():
+        return
+    facet = 'purpose' if sender is Product.purpose.through else 'body_part'
+    if reverse and action == 'post_clear':
+        # the instance is the taxonomy option; clear it from every product that has it
+        update_index_on_commit(product_index.remove_option_products, facet, instance.pk)
+        return
+    if reverse:
+        # the instance is the taxonomy option; pk_set holds product ids
+        option_ids = [instance.pk]
+        product_ids = set(pk_set)
+    else:
+        option_ids = None if action == 'post_clear' else set(pk_set)
+        product_ids = [instance.pk]
+
+    if action == 'post_add':
+        update_index_on_commit(product_index.add_product_options, facet, product_ids, option_ids)
+    else:
+        update_index_on_commit(product_index.remove_product_options, facet, product_ids, option_ids)
+
+post_save.connect(index_product, sender=Product)
+post_delete.connect(unindex_product, sender=Product)
+for model in TAXONOMY_FACETS:
+    post_save.connect(index_taxonomy, sender=model)
+    post_delete.connect(unindex_taxonomy, sender=model)
+for through in (Product.purpose.through, Product.body_parts.through):
+    m2m_changed.connect(index_product_m2m, sender=through)
+
+
+# Keep the full-text search index in sync; the old entry has to be removed before the product row changes
+
+def unindex_product_search(sender, instance, raw=False, using='default', **kwargs):
+    if instance.pk and not raw and search.is_available(using):
+        search.remove_product(instance.pk, using=using)
+
+def index_product_search(sender, instance, raw=False, using='default', **kwargs):
+    if not raw and search.is_available(using):
+        search.update_product(instance.pk, instance.name, instance.description, using=using)
+
+pre_save.connect(unindex_product_search, sender=Product)
+post_save.connect(index_product_search, sender=Product)
+pre_delete.connect(unindex_product_search, sender=Product)
+
+
+# Product cards are cached per product `updated_at` (see a_products.cards); image changes have to touch the product too
+
+def touch_product(sender, instance, **kwargs):
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+    # the slug cache holds the product together with its images
+    slugs.invalidate_slug(instance.product.slug)
+
+post_save.connect(touch_product, sender=ProductImage)
+post_delete.connect(touch_product, sender=ProductImage)
+
+
+# Drop cached slug lookups (see a_products.slugs); saving renames the product when its name changed
+
+def invalidate_old_product_slug(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        old_slug = Product.objects.filter(pk=instance.pk).values_list('slug', flat=True).first()
+        if old_slug:
+            slugs.invalidate_slug(old_slug)
+
+def invalidate_product_slug(sender, instance, **kwargs):
+    # also clears a negative entry cached before a product with this slug existed
+    slugs.invalidate_slug(instance.slug)
+
+pre_save.connect(invalidate_old_product_slug, sender=Product)
+post_save.connect(invalidate_product_slug, sender=Product)
+post_delete.connect(invalidate_product_slug, sender=Product)
+
+
+# Generate resized copies of new images, off the request path (see a_core.images)
+
+def generate_image_derivatives(sender, instance, raw=False, **kwargs):
+    if not raw and needs_derivatives(instance.image, instance.derivatives):
+        schedule_derivatives(instance, 'image', 'derivatives')
+
+post_save.connect(generate_image_derivatives, sender=ProductImage)
@@ -0,0 +1,43 @@
+"""
+Cached slug -> product resolution for the product detail page.
+
+Found products are cached (with their images) under their slug, and unknown slugs get a
+short-lived negative entry, so repeated hits on dead URLs don't reach the database either.
+The signals in `a_products.signals` drop the entries of a product's old and new slug when
+it's saved (which may rename it, as the slug follows the name) or deleted, and when its
+images change.
+"""
+import hashlib
+from django.core.cache import cache
+from .models import Product
+
+SLUG_CACHE_TIMEOUT = 60 * 15  # 15 minutes; entries are also dropped on changes
+MISSING_SLUG_TIMEOUT = 60  # 1 minute, so new products show up quickly even without a signal
+MISSING = 'missing'  # cached for slugs without a product
+
+def get_slug_cache_key(slug):
+    # slugs come straight from the URL; hash them to keep keys short and safe for any cache backend
+    return f"a_products:slug:{hashlib.md5(slug.encode()).hexdigest()}"
+
+def resolve_product(slug):
+    """
+    Look up a product (with its images) by slug, from the cache where possible.
+
+    :param slug: The product slug
+    :return: The product, or None if there is no product with that slug
+    """
+    cache_key = get_slug_cache_key(slug)
+    product = cache.get(cache_key)
+    if product is None:
+        product = Product.objects.with_images().filter(slug=slug).first()
+        if product is None:
+            cache.set(cache_key, MISSING, MISSING_SLUG_TIMEOUT)
+        else:
+            cache.set(cache_key, product, SLUG_CACHE_TIMEOUT)
+    return None if product == MISSING else product
+
+def invalidate_slug(slug):
+    cache.delete(get_slug_cache_key(slug))
+
+def invalidate_slugs(slugs):
+    cache.delete_many([get_slug_cache_key(slug) for slug in slugs])
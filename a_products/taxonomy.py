@@ -0,0 +1,80 @@
+"""
+Process-local registry of the product taxonomy (categories, purposes, materials and body parts).
+
+The taxonomy changes rarely but is needed on every product list request, for the filter
+sidebar and for validating filter slugs. The registry loads the four tables once per
+process and serves them from memory. Saving or deleting a taxonomy option bumps the
+taxonomy version in the cache (see `a_products.signals`), which makes every process
+reload the registry on its next use. This relies on a cache shared by all processes
+(the CACHES setting), not a per-process LocMemCache.
+"""
+import threading
+import uuid
+from django.core.cache import cache
+from .models import Category, Purpose, Material, BodyPart
+
+TAXONOMY_VERSION_KEY = 'a_products:taxonomy_version'
+
+# facet name -> taxonomy model, matching the keys of FILTER_LOOKUPS
+TAXONOMY_MODELS = {
+    'category': Category,
+    'purpose': Purpose,
+    'material': Material,
+    'body_part': BodyPart,
+}
+
+def get_taxonomy_version():
+    return cache.get_or_set(TAXONOMY_VERSION_KEY, lambda: uuid.uuid4().hex, timeout=None)
+
+def bump_taxonomy_version():
+    cache.set(TAXONOMY_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+class TaxonomyRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._options = {}  # facet -> list of options, in database order
+        self._slugs = {}  # facet -> {slug: option}
+        self.version = None  # taxonomy version the registry reflects
+
+    def load(self):
+        """
+        (Re)load all taxonomy tables, with one query per table.
+        """
+        version = get_taxonomy_version()
+        options = {facet: list(model.objects.all()) for facet, model in TAXONOMY_MODELS.items()}
+        with self._lock:
+            self._options = options
+            self._slugs = {facet: {option.slug: option for option in facet_options} for facet, facet_options in options.items()}
+            self.version = version
+
+    def ensure_current(self):
+        """
+        Load the registry if needed, or reload it if the taxonomy changed in any process.
+        """
+        if self.version is None or self.version != get_taxonomy_version():
+            self.load()
+
+    def get_options(self, facet):
+        return self._options[facet]
+
+    def get_option(self, facet, slug):
+        """
+        :return: The taxonomy option with the given slug, or None if there is none
+        """
+        return self._slugs[facet].get(slug)
+
+    def clean_slugs(self, facet, slugs):
+        """
+        Return the slugs (in the given order) that belong to an existing option of the facet.
+        """
+        known = self._slugs[facet]
+        return [slug for slug in slugs if slug in known]
+
+taxonomy = TaxonomyRegistry()
+
+def get_taxonomy():
+    """
+    Return the up-to-date process-wide taxonomy registry.
+    """
+    taxonomy.ensure_current()
+    return taxonomy
@@ -1,7 +1,39 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory
+from django.http import HttpResponse
+from django.contrib.sessions.backends.db import SessionStore
 from django.urls import reverse
-from .models import Product, Category
+from django.core.cache import cache
+from django.test import override_settings
+from django.conf import settings
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+import csv
+import gzip
+import io
+import json
+from decimal import Decimal
+import os
+import subprocess
+import sys
+import tempfile
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.files.storage import default_storage
+from a_core.views import serve_media
+from .models import Product, Category, Purpose, Material, BodyPart, ProductImage, SORT_OPTIONS
+from .bitmap_index import product_index, ids_to_bitset, bitset_to_ids
+from .pagination import get_page, after_keyset
+from .cards import render_product_cards
+from .feeds import generate_feed
+from .page_cache import cache_catalog_page
+from .taxonomy import get_taxonomy
+from .facets import get_facet_counts, filter_with_facets, get_price_histogram
 from a_cart.models import Cart
+from django.contrib.auth.models import User
 
 class ProductModelTests(TestCase):
     def setUp(self):
@@ -20,6 +52,24 @@ class ProductModelTests(TestCase):
     def test_product_str_method(self):
         self.assertEqual(str(self.product), "Test Product")
 
+    def test_colliding_slugs_are_numbered(self):
+        self.assertEqual(Product.objects.create(name="Test product!", price=5.00).slug, 'test-product-2')
+        renamed = Product.objects.create(name="Other", price=5.00)
+        renamed.name = "Test  Product"
+        renamed.save()
+        self.assertEqual(renamed.slug, 'test-product-3')
+        # saving without a rename keeps the numbered slug
+        Product.objects.get(pk=renamed.pk).save()
+        self.assertEqual(Product.objects.get(pk=renamed.pk).slug, 'test-product-3')
+
+    def test_slug_follows_a_rename_that_drops_trailing_digits(self):
+        plug = Product.objects.create(name="Plug 2", price=5.00)
+        self.assertEqual(plug.slug, 'plug-2')
+        plug = Product.objects.get(pk=plug.pk)
+        plug.name = "Plug"
+        plug.save()
+        self.assertEqual(Product.objects.get(pk=plug.pk).slug, 'plug')
+
 class ProductQuerySetTests(TestCase):
     def setUp(self):
         self.category1 = Category.objects.create(name="Category 1")
@@ -41,6 +91,49 @@ class ProductQuerySetTests(TestCase):
         self.assertIn(self.product2, filtered_products)
         self.assertNotIn(self.product3, filtered_products)
 
+class ProductQuerySetM2MTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Category 1")
+        Material.objects.create(name="Leather")
+        self.purposes = [Purpose.objects.create(name=f"Purpose {i}") for i in range(3)]
+        self.body_parts = [BodyPart.objects.create(name=f"Body part {i}") for i in range(3)]
+        self.product1 = Product.objects.create(name="Product 1", category=self.category, price=10.00)
+        self.product2 = Product.objects.create(name="Product 2", price=20.00)
+        self.product1.purpose.add(*self.purposes)
+        self.product1.body_parts.add(*self.body_parts)
+        self.product2.purpose.add(self.purposes[0])
+
+    def test_m2m_filters_return_each_product_once(self):
+        filtered_products = Product.objects.filter_by_params(
+            purpose=[p.slug for p in self.purposes],
+            body_part=[b.slug for b in self.body_parts],
+        )
+        self.assertEqual(list(filtered_products), [self.product1])
+        self.assertEqual(Product.objects.filter_by_params(purpose=[p.slug for p in self.purposes]).count(), 2)
+
+    def test_m2m_filters_do_not_join_the_through_tables(self):
+        sql = str(Product.objects.filter_by_params(purpose=self.purposes[0].slug, body_part=self.body_parts[0].slug).query)
+        self.assertNotIn('DISTINCT', sql)
+        self.assertEqual(sql.count('EXISTS'), 2)
+
+    def test_plan_stays_index_driven_as_filters_grow(self):
+        filter_sets = [
+            {'purpose': [self.purposes[0].slug]},
+            {'purpose': [p.slug for p in self.purposes]},
+            {'purpose': [p.slug for p in self.purposes], 'body_part': [b.slug for b in self.body_parts]},
+            {'category': [self.category.slug], 'material': ['leather'], 'purpose': [p.slug for p in self.purposes], 'body_part': [b.slug for b in self.body_parts]},
+        ]
+        for params in filter_sets:
+            plan = Product.objects.filter_by_params(**params).explain()
+            with self.subTest(params=params):
+                for line in plan.splitlines():
+                    # only the products themselves may be scanned; the taxonomy and through tables are searched by index
+                    if 'SCAN' in line:
+                        self.assertIn('SCAN a_products_product', line)
+                        self.assertNotIn('SCAN a_products_product_', line)
+                self.assertIn('USING COVERING INDEX', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
 class ProductViewTests(TestCase):
     def setUp(self):
         self.client = Client()
@@ -74,12 +167,964 @@ class ProductViewTests(TestCase):
         self.assertContains(response, "No products available.")
         self.assertNotContains(response, '<header class="max-w-7xl mx-auto">')
 
-    def test_cart_creation_for_anonymous_user(self):
+    def test_no_cart_for_browsing_anonymous_user(self):
         response = self.client.get(reverse('products:home'))
         self.assertEqual(response.status_code, 200)
-        
-        # Check if a cart was created for the session for an anonymous user
-        session_cart_id = self.client.session.get('cart_id')
-        session_cart = Cart.objects.get(id=session_cart_id)
-        self.assertIsNotNone(session_cart)
-        self.assertIsNone(session_cart.user)
\ No newline at end of file
+        # the page loads the cart menu of the navbar separately
+        response = self.client.get(reverse('cart:navbar_menus'))
+        self.assertContains(response, '0 Items')
+
+        # browsing creates neither a cart nor a session; adding a product does
+        self.assertFalse(Cart.objects.exists())
+        self.assertNotIn('cart_id', self.client.session)
+        self.client.post(reverse('cart:add_to_cart'), {'product_id': self.product.id, 'quantity': 1})
+        session_cart = Cart.objects.get(id=self.client.session['cart_id'])
+        self.assertIsNone(session_cart.user)
+
+class ProductQueryCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.category = Category.objects.create(name="Test Category")
+
+    def create_products(self, count):
+        products = []
+        for i in range(count):
+            product = Product.objects.create(name=f"Product {len(Product.objects.all()) + 1}", category=self.category, price=10.00)
+            ProductImage.objects.create(product=product, image=f'product_images/{product.slug}-1.jpg', is_primary=True)
+            ProductImage.objects.create(product=product, image=f'product_images/{product.slug}-2.jpg', is_secondary=True)
+            ProductImage.objects.create(product=product, image=f'product_images/{product.slug}-3.jpg')
+            products.append(product)
+        return products
+
+    def test_with_card_images_uses_preloaded_images(self):
+        product = self.create_products(1)[0]
+        product = Product.objects.with_card_images().get(pk=product.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(product.get_primary_image().is_primary)
+            self.assertTrue(product.get_secondary_image().is_secondary)
+
+    def test_view_list_query_count_does_not_grow_with_products(self):
+        # the cart and its session are loaded separately (see cart:navbar_menus); the catalog is summarized for the ETag
+        self.create_products(3)
+        with self.assertNumQueries(11):
+            response = Client().get(reverse('products:home'))
+        self.assertContains(response, 'product_images/product-1-1.jpg')
+        self.assertContains(response, 'product_images/product-1-2.jpg')
+
+        # the taxonomy for the filter sidebar is now served from the registry
+        self.create_products(20)
+        with self.assertNumQueries(7):
+            Client().get(reverse('products:home'))
+
+    def test_view_list_htmx_query_count(self):
+        self.create_products(10)
+        with self.assertNumQueries(11):
+            self.client.get(reverse('products:home'), HTTP_HX_REQUEST='true')
+
+    def test_view_product_query_count(self):
+        product = self.create_products(1)[0]
+        with self.assertNumQueries(3):
+            response = self.client.get(product.get_absolute_url())
+        self.assertContains(response, 'product_images/product-1-3.jpg')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name="Test Product", price=15.00)
+        self.url = reverse('products:home')
+
+    def test_unchanged_list_is_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        # the catalog state is cached until the catalog changes
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('HX-Request', response['Vary'])
+
+    def test_htmx_partial_has_its_own_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'], HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 304)
+
+    def test_catalog_changes_modify_the_pages(self):
+        detail_url = self.product.get_absolute_url()
+        list_etag, detail_etag = self.client.get(self.url)['ETag'], self.client.get(detail_url)['ETag']
+        ProductImage.objects.create(product=self.product, image='product_images/test.jpg', is_primary=True)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=list_etag).status_code, 200)
+        self.assertEqual(self.client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag).status_code, 200)
+
+        etag = self.client.get(self.url)['ETag']
+        Category.objects.create(name="New Category")
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_last_modified(self):
+        response = self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name="Test Product", price=15.00)
+        self.url = reverse('products:home')
+
+    def test_pages_are_shared_between_visitors(self):
+        response = self.client.get(self.url)
+        self.assertNotContains(response, 'csrfmiddlewaretoken" value')
+
+        # a visitor with a session, cart and login gets the same page, from the cache
+        user = User.objects.create_user(username='testuser', password='12345')
+        Cart.objects.create(user=user).add_product(self.product)
+        self.client.force_login(user)
+        self.client.get(reverse('cart:navbar_menus'))
+        with self.assertNumQueries(4):  # only the session save (SESSION_SAVE_EVERY_REQUEST)
+            cached = self.client.get(self.url)
+        self.assertEqual((cached.content, cached['ETag']), (response.content, response['ETag']))
+        self.assertNotContains(cached, 'testuser')
+
+    def test_htmx_partials_are_cached_separately(self):
+        page = self.client.get(self.url)
+        partial = self.client.get(self.url, HTTP_HX_REQUEST='true')
+        self.assertNotEqual(page.content, partial.content)
+        self.assertEqual(self.client.get(self.url, HTTP_HX_REQUEST='true').content, partial.content)
+        self.assertEqual(self.client.get(self.url).content, page.content)
+
+    def test_catalog_changes_refresh_the_pages(self):
+        self.client.get(self.url)
+        Product.objects.create(name="New Product", price=20.00)
+        self.assertContains(self.client.get(self.url), "New Product")
+
+    def test_per_visitor_responses_are_not_cached(self):
+        calls = []
+
+        @cache_catalog_page
+        def view(request):
+            calls.append(request)
+            if 'session' in request.GET:
+                request.session.get('cart_id')
+            return HttpResponse('page')
+
+        for path in ['/page/', '/page/?session', '/page/', '/page/?session']:
+            request = RequestFactory().get(path)
+            request.session = SessionStore()
+            view(request)
+        self.assertEqual(len(calls), 3)
+
+
+class ProductImagePointerTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name="Test Product", price=15.00)
+
+    def create_image(self, number, **flags):
+        return ProductImage.objects.create(product=self.product, image=f'product_images/{number}.jpg', **flags)
+
+    def test_flags_are_mirrored_on_the_product(self):
+        first = self.create_image(1, is_primary=True)
+        second = self.create_image(2, is_secondary=True)
+        self.assertEqual((self.product.primary_image_id, self.product.secondary_image_id), (first.pk, second.pk))
+
+        # re-flagging moves the pointer and unflags the previous image
+        third = self.create_image(3, is_primary=True)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.get_primary_image(), third)
+        first.refresh_from_db()
+        self.assertFalse(first.is_primary)
+
+        # a primary image can't be the secondary one too
+        second.is_primary = True
+        second.save()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.primary_image_id, self.product.secondary_image_id), (second.pk, None))
+
+    def test_unflagging_and_deleting_clear_the_pointer(self):
+        image = self.create_image(1, is_primary=True)
+        image.is_primary = False
+        image.save()
+        self.product.refresh_from_db()
+        self.assertIsNone(self.product.primary_image_id)
+
+        image = self.create_image(2, is_secondary=True)
+        image.delete()
+        self.product.refresh_from_db()
+        self.assertIsNone(self.product.get_secondary_image())
+
+    def test_stale_product_save_keeps_pointers(self):
+        stale = Product.objects.get(pk=self.product.pk)
+        image = self.create_image(1, is_primary=True)
+        stale.price = 20.00
+        stale.save()
+        self.assertEqual(Product.objects.get(pk=self.product.pk).primary_image_id, image.pk)
+
+    def test_saving_a_new_product_with_a_given_pk_inserts_it(self):
+        product = Product(pk=self.product.pk + 100, name="Given Pk", price=10.00)
+        product.save()
+        self.assertTrue(Product.objects.filter(pk=product.pk, name="Given Pk").exists())
+
+    def test_saving_an_image_does_not_scan_the_product_images(self):
+        self.create_image(1, is_primary=True)
+        with CaptureQueriesContext(connection) as queries:
+            self.create_image(2, is_primary=True)
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE "a_products_productimage"') and '"product_id"' in query['sql']])
+
+    def test_migration_backfills_pointers(self):
+        from importlib import import_module
+        from django.apps import apps
+        image = self.create_image(1, is_primary=True)
+        Product.objects.update(primary_image=None)
+        import_module('a_products.migrations.0006_product_image_pointers').backfill_image_pointers(apps, None)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).primary_image_id, image.pk)
+
+    def test_card_images_are_joined(self):
+        self.create_image(1, is_primary=True)
+        self.create_image(2, is_secondary=True)
+        with self.assertNumQueries(1):
+            product = Product.objects.with_card_images().get(pk=self.product.pk)
+            self.assertEqual(product.get_primary_image().image.name, 'product_images/1.jpg')
+            self.assertEqual(product.get_secondary_image().image.name, 'product_images/2.jpg')
+
+
+class ProductCardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name="Test Category")
+        self.product = Product.objects.create(name="Product 1", category=self.category, price=10.00)
+        self.image = ProductImage.objects.create(product=self.product, image='product_images/product-1-1.jpg', is_primary=True)
+
+    def render_card(self):
+        return render_product_cards([Product.objects.get(pk=self.product.pk)])[0]
+
+    def test_cached_cards_are_not_rendered_again(self):
+        self.render_card()
+        with self.assertNumQueries(1), self.assertTemplateNotUsed('products/partials/product_card.html'):
+            card = self.render_card()
+        self.assertIn('product_images/product-1-1.jpg', card)
+
+    def test_product_change_invalidates_card(self):
+        self.render_card()
+        self.product.price = 12.50
+        self.product.save()
+        self.assertIn('12.50', self.render_card())
+
+    def test_image_changes_invalidate_card(self):
+        self.render_card()
+        ProductImage.objects.create(product=self.product, image='product_images/product-1-2.jpg', is_primary=True)
+        self.assertIn('product_images/product-1-2.jpg', self.render_card())
+        ProductImage.objects.filter(is_primary=True).get().delete()
+        self.assertNotIn('product_images/product-1-2.jpg', self.render_card())
+
+    def test_view_list_uses_cached_cards(self):
+        self.client.get(reverse('products:home'), HTTP_HX_REQUEST='true')
+        with self.assertTemplateNotUsed('products/partials/product_card.html'):
+            response = self.client.get(reverse('products:home'), HTTP_HX_REQUEST='true')
+        self.assertContains(response, 'product_images/product-1-1.jpg')
+
+
+class ProductSlugCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name="Test Product", price=15.00)
+        self.image = ProductImage.objects.create(product=self.product, image='product_images/test-product-1.jpg', is_primary=True)
+
+    def test_detail_page_is_served_from_cache(self):
+        self.client.get(self.product.get_absolute_url(), HTTP_HX_REQUEST='true')
+        with self.assertNumQueries(0):
+            response = self.client.get(self.product.get_absolute_url(), HTTP_HX_REQUEST='true')
+        self.assertContains(response, 'product_images/test-product-1.jpg')
+
+    def test_unknown_slug_is_a_cached_404(self):
+        url = reverse('products:view_product', kwargs={'slug': 'no-such-product'})
+        self.assertEqual(self.client.get(url, HTTP_HX_REQUEST='true').status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_HX_REQUEST='true').status_code, 404)
+        # creating the product clears the negative entry
+        Product.objects.create(name="No such product", price=10.00)
+        self.assertEqual(self.client.get(url, HTTP_HX_REQUEST='true').status_code, 200)
+
+    def test_rename_invalidates_old_and_new_slug(self):
+        old_url = self.product.get_absolute_url()
+        new_url = reverse('products:view_product', kwargs={'slug': 'renamed-product'})
+        self.client.get(old_url, HTTP_HX_REQUEST='true')
+        self.client.get(new_url, HTTP_HX_REQUEST='true')
+        self.product.name = "Renamed Product"
+        self.product.save()
+        self.assertEqual(self.client.get(old_url, HTTP_HX_REQUEST='true').status_code, 404)
+        self.assertContains(self.client.get(new_url, HTTP_HX_REQUEST='true'), "Renamed Product")
+
+    def test_image_and_delete_invalidate_slug(self):
+        url = self.product.get_absolute_url()
+        self.client.get(url, HTTP_HX_REQUEST='true')
+        ProductImage.objects.create(product=self.product, image='product_images/test-product-2.jpg')
+        self.assertContains(self.client.get(url, HTTP_HX_REQUEST='true'), 'product_images/test-product-2.jpg')
+        self.product.delete()
+        self.assertEqual(self.client.get(url, HTTP_HX_REQUEST='true').status_code, 404)
+
+
+def make_image_file(name='photo.png', size=(200, 100)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+@override_settings(IMAGE_DERIVATIVE_WORKERS=0, IMAGE_DERIVATIVE_WIDTHS=[100, 400], IMAGE_DERIVATIVE_FORMATS=['webp', 'jpeg'])
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root.name))
+        self.addCleanup(self.media_root.cleanup)
+        self.product = Product.objects.create(name="Test Product", price=15.00)
+
+    def create_image(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(product=self.product, image=make_image_file(), is_primary=True)
+        image.refresh_from_db()
+        return image
+
+    def test_derivatives_are_generated_after_upload(self):
+        image = self.create_image()
+        self.assertEqual(image.derivatives['source'], image.image.name)
+        for fmt in ['webp', 'jpeg']:
+            # never upscaled beyond the original width
+            self.assertEqual([(d['width'], d['height']) for d in image.derivatives['formats'][fmt]], [(100, 50), (200, 100)])
+            for derivative in image.derivatives['formats'][fmt]:
+                self.assertTrue(os.path.exists(os.path.join(self.media_root.name, derivative['name'])))
+        self.assertEqual([source['type'] for source in image.get_sources()], ['image/webp', 'image/jpeg'])
+
+    def test_formats_pillow_cant_encode_are_skipped(self):
+        Image.init()
+        with mock.patch.dict(Image.SAVE), self.settings(IMAGE_DERIVATIVE_FORMATS=['avif', 'webp']), self.assertLogs('a_core.images', 'WARNING'):
+            Image.SAVE.pop('AVIF', None)
+            image = self.create_image()
+        self.assertEqual(list(image.derivatives['formats']), ['webp'])
+        self.assertTrue(image.get_placeholder())
+
+    def test_card_offers_derivatives(self):
+        self.create_image()
+        card = render_product_cards([Product.objects.get(pk=self.product.pk)])[0]
+        self.assertIn('<source type="image/webp"', card)
+        self.assertIn('.webp 100w', card)
+        self.assertIn('loading="lazy"', card)
+        self.assertIn("background-image: url('data:image/webp;base64,", card)
+
+    def test_placeholder_is_tiny(self):
+        image = self.create_image()
+        self.assertTrue(image.get_placeholder().startswith('data:image/webp;base64,'))
+        self.assertLess(len(image.get_placeholder()), 500)
+
+    def test_replaced_image_drops_outdated_derivatives(self):
+        image = self.create_image()
+        image.image = make_image_file('other.png', size=(50, 50))
+        image.save()  # without running the on_commit callbacks
+        self.assertEqual(image.get_sources(), [])
+
+    def test_backfill_command(self):
+        image = self.create_image()
+        ProductImage.objects.filter(pk=image.pk).update(derivatives={})
+        with mock.patch('a_core.management.commands.generate_image_derivatives.get_executor', lambda max_workers: ThreadPoolExecutor(max_workers)):
+            call_command('generate_image_derivatives', workers=2, stdout=io.StringIO())
+        image.refresh_from_db()
+        self.assertEqual(image.derivatives['source'], image.image.name)
+
+
+class ContentAddressedMediaTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root.name, IMAGE_DERIVATIVE_WORKERS=0))
+        self.addCleanup(self.media_root.cleanup)
+        self.product1 = Product.objects.create(name="Product 1", price=10.00)
+        self.product2 = Product.objects.create(name="Product 2", price=20.00)
+
+    def test_identical_uploads_are_stored_once(self):
+        image1 = ProductImage.objects.create(product=self.product1, image=make_image_file('front.PNG'))
+        image2 = ProductImage.objects.create(product=self.product2, image=make_image_file('copy.png'))
+        other = ProductImage.objects.create(product=self.product2, image=make_image_file('other.png', size=(10, 10)))
+        self.assertEqual(image1.image.name, image2.image.name)
+        self.assertNotEqual(image1.image.name, other.image.name)
+        self.assertRegex(image1.image.name, r'^product_images/[0-9a-f]{64}\.png$')
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root.name, 'product_images'))), 2)
+
+    def test_concurrent_identical_uploads_keep_the_content_name(self):
+        image1 = ProductImage.objects.create(product=self.product1, image=make_image_file())
+        # the other upload created the file between the existence check and the write
+        exists = default_storage.exists
+        checked = []
+        def exists_after_first_check(name):
+            if name == image1.image.name and not checked:
+                checked.append(name)
+                return False
+            return exists(name)
+        with mock.patch.object(default_storage, 'exists', exists_after_first_check):
+            image2 = ProductImage.objects.create(product=self.product2, image=make_image_file('copy.png'))
+        self.assertEqual(image1.image.name, image2.image.name)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root.name, 'product_images'))), 1)
+
+    def serve_media(self, url):
+        return serve_media(RequestFactory().get(url), url.removeprefix(settings.MEDIA_URL).lstrip('/'))
+
+    def test_media_is_served_immutable(self):
+        image = ProductImage.objects.create(product=self.product1, image=make_image_file())
+        response = self.serve_media(image.image.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertIn('Expires', response)
+
+    def test_legacy_names_are_not_immutable(self):
+        os.makedirs(os.path.join(self.media_root.name, 'product_images'))
+        with open(os.path.join(self.media_root.name, 'product_images', 'photo.jpg'), 'wb') as file:
+            file.write(b'legacy')
+        response = self.serve_media('/media/product_images/photo.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Cache-Control', response)
+
+    def test_media_is_not_served_without_debug(self):
+        image = ProductImage.objects.create(product=self.product1, image=make_image_file())
+        self.assertEqual(self.client.get(image.image.url).status_code, 404)
+
+
+class ImportProductsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.toys = Category.objects.create(name="Toys")
+        self.play = Purpose.objects.create(name="Play")
+        self.existing = Product.objects.create(name="Foo & Bar", price=5.00)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def import_file(self, filename, content, *args):
+        path = os.path.join(self.directory.name, filename)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        stdout = io.StringIO()
+        call_command('import_products', path, *args, stdout=stdout, stderr=io.StringIO())
+        return stdout.getvalue()
+
+    def test_import_csv(self):
+        output = self.import_file('products.csv', (
+            "name,price,description,category,material,purpose,body_parts\n"
+            "Leather Cuffs,29.95,Soft leather cuffs,Toys,Leather,Play|Style,Hands|Feet\n"
+            "Foo Bar,10,,toys,,,\n"
+            "Broken,not a price,,,,,\n"
+        ), '--create-taxonomy', '--batch-size', '2')
+        self.assertIn('3 rows', output)
+        self.assertIn('2 created, 0 updated, 1 skipped', output)
+        cuffs = Product.objects.get(name="Leather Cuffs")
+        self.assertEqual((cuffs.slug, cuffs.price, cuffs.category, cuffs.material.slug), ('leather-cuffs', Decimal('29.95'), self.toys, 'leather'))
+        self.assertEqual(sorted(cuffs.purpose.values_list('slug', flat=True)), ['play', 'style'])
+        self.assertEqual(sorted(cuffs.body_parts.values_list('slug', flat=True)), ['feet', 'hands'])
+        # 'Foo Bar' has the same base slug as the existing 'Foo & Bar'
+        self.assertEqual(Product.objects.get(name="Foo Bar").slug, 'foo-bar-2')
+
+    def test_import_jsonl_updates_existing_products(self):
+        lines = [
+            {'name': "Foo & Bar", 'price': '7.50', 'category': 'toys', 'purpose': ['play']},
+            {'name': "Foo Bar", 'price': 10},
+            {'name': "Foo-Bar", 'price': 11},
+        ]
+        self.import_file('products.jsonl', '\n'.join(json.dumps(line) for line in lines))
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.price, self.existing.category, list(self.existing.purpose.all())), (Decimal('7.50'), self.toys, [self.play]))
+        self.assertEqual(Product.objects.get(name="Foo Bar").slug, 'foo-bar-2')
+        self.assertEqual(Product.objects.get(name="Foo-Bar").slug, 'foo-bar-3')
+
+        # importing again updates the same products, and keeps the numbered slugs
+        output = self.import_file('products.jsonl', '\n'.join(json.dumps(line) for line in lines))
+        self.assertIn('0 created, 3 updated', output)
+        self.assertEqual(Product.objects.count(), 3)
+        foo_bar = Product.objects.get(name="Foo Bar")
+        foo_bar.save()
+        self.assertEqual(foo_bar.slug, 'foo-bar-2')
+
+    def test_imported_products_are_searchable_and_counted(self):
+        self.assertEqual(get_facet_counts({})['category'], {})
+        self.import_file('products.csv', "name,price,category\nVelvet Blindfold,12,Toys\n")
+        self.assertEqual([p.name for p in Product.objects.search("velvet")], ["Velvet Blindfold"])
+        self.assertEqual(get_facet_counts({})['category'], {'toys': 1})
+
+
+class ProductFeedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.toys = Category.objects.create(name="Toys")
+        self.play = Purpose.objects.create(name="Play")
+        self.products = [Product.objects.create(name=f"Product {i:02d}", price=10 + i, category=self.toys) for i in range(5)]
+        self.products[0].purpose.add(self.play)
+        Product.objects.create(name='Tom & "Jerry" <3', price=1)
+
+    def get_feed(self, url, **headers):
+        response = self.client.get(url, **headers)
+        return response, b''.join(response.streaming_content) if response.status_code == 200 else b''
+
+    def test_csv_feed(self):
+        response, content = self.get_feed(reverse('products:feed', kwargs={'file_format': 'csv'}))
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.DictReader(io.StringIO(content.decode())))
+        self.assertEqual([row['title'] for row in rows], [*(p.name for p in self.products), 'Tom & "Jerry" <3'])
+        self.assertEqual(rows[0]['link'], f'http://testserver/products/{self.products[0].slug}/')
+        self.assertEqual((rows[0]['price'], rows[0]['product_type'], rows[0]['purpose']), ('10.00 EUR', 'Toys', 'Play'))
+
+    def test_xml_feed_gzip(self):
+        response, content = self.get_feed('/feeds/products.xml.gz')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        root = ElementTree.fromstring(gzip.decompress(content))
+        self.assertEqual([item.findtext('title') for item in root], [*(p.name for p in self.products), 'Tom & "Jerry" <3'])
+
+    def test_feed_streams_in_chunks(self):
+        # one query for each chunk of products and one for each of its two M2M prefetches, and one finding no more products
+        with self.assertNumQueries(3 * 3 + 1):
+            rows = list(generate_feed('csv', 'http://testserver', chunk_size=2))
+        self.assertEqual(len(rows), 1 + 6)
+
+    def test_conditional_get(self):
+        url = reverse('products:feed', kwargs={'file_format': 'csv'})
+        response, content = self.get_feed(url)
+        etag = response['ETag']
+        # the catalog state is cached until the catalog changes
+        with self.assertNumQueries(0):
+            response, content = self.get_feed(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # a changed, or deleted product changes the feed
+        self.products[1].delete()
+        response, content = self.get_feed(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        # the compressed feed is a different representation
+        response, content = self.get_feed(url + '.gz', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_export_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'products.csv.gz')
+            call_command('export_products', path, '--base-url', 'https://example.com/', stdout=io.StringIO())
+            with gzip.open(path, 'rt') as file:
+                rows = list(csv.DictReader(file))
+            self.assertEqual(os.listdir(directory), ['products.csv.gz'])
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0]['link'], f'https://example.com/products/{self.products[0].slug}/')
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.toys = Category.objects.create(name="Toys")
+        self.wear = Category.objects.create(name="Wear")
+        self.silicone = Material.objects.create(name="Silicone")
+        self.leather = Material.objects.create(name="Leather")
+        self.play = Purpose.objects.create(name="Play")
+        self.style = Purpose.objects.create(name="Style")
+        self.product1 = Product.objects.create(name="Product 1", category=self.toys, material=self.silicone, price=10.00)
+        self.product2 = Product.objects.create(name="Product 2", category=self.toys, material=self.leather, price=20.00)
+        self.product3 = Product.objects.create(name="Product 3", category=self.wear, material=self.leather, price=30.00)
+        self.product1.purpose.add(self.play, self.style)
+        self.product3.purpose.add(self.style)
+
+    def test_counts_without_filters(self):
+        counts = get_facet_counts({})
+        self.assertEqual(counts['category'], {'toys': 2, 'wear': 1})
+        self.assertEqual(counts['material'], {'silicone': 1, 'leather': 2})
+        self.assertEqual(counts['purpose'], {'play': 1, 'style': 2})
+        self.assertEqual(counts['body_part'], {})
+
+    def test_counts_ignore_own_facet_filter(self):
+        counts = get_facet_counts({'category': 'toys'})
+        # the category facet still counts the other categories
+        self.assertEqual(counts['category'], {'toys': 2, 'wear': 1})
+        # the other facets only count products in the selected category
+        self.assertEqual(counts['material'], {'silicone': 1, 'leather': 1})
+        self.assertEqual(counts['purpose'], {'play': 1, 'style': 1})
+
+    def test_counts_use_bounded_number_of_queries(self):
+        get_taxonomy()
+        with self.assertNumQueries(4):
+            get_facet_counts({'category': ['toys', 'wear'], 'material': 'leather', 'purpose': 'style'})
+
+    def test_counts_are_cached_per_normalized_filter_set(self):
+        get_facet_counts({'category': ['wear', 'toys']})
+        with self.assertNumQueries(0):
+            get_facet_counts({'category': ['toys', 'wear', ''], 'unknown': 'x'})
+
+    def test_cached_counts_are_invalidated_on_catalog_change(self):
+        self.assertEqual(get_facet_counts({})['category'], {'toys': 2, 'wear': 1})
+        Product.objects.create(name="Product 4", category=self.wear, price=40.00)
+        self.assertEqual(get_facet_counts({})['category'], {'toys': 2, 'wear': 2})
+        self.product1.purpose.remove(self.play)
+        self.assertEqual(get_facet_counts({})['purpose'], {'style': 2})
+
+    def test_filter_with_facets(self):
+        products, counts, params = filter_with_facets({'category': 'toys', 'material': 'leather'})
+        self.assertEqual(list(products), [self.product2])
+        self.assertEqual(params, {'category': ('toys',), 'material': ('leather',)})
+        self.assertEqual(counts['category'], {'toys': 1, 'wear': 1})
+
+    def test_price_range_filter(self):
+        self.assertEqual(list(Product.objects.filter_by_params(price_min='15')), [self.product2, self.product3])
+        self.assertEqual(list(Product.objects.filter_by_params(price_min=['15'], price_max=['25.50'])), [self.product2])
+        # malformed prices are ignored
+        self.assertEqual(Product.objects.filter_by_params(price_min='abc', price_max='NaN').count(), 3)
+
+    def test_counts_apply_price_range(self):
+        counts = get_facet_counts({'price_max': '20'})
+        self.assertEqual(counts['category'], {'toys': 2})
+        self.assertEqual(counts['material'], {'silicone': 1, 'leather': 1})
+
+    def test_price_histogram(self):
+        Product.objects.create(name="Product 4", category=self.wear, price=39.99)
+        get_taxonomy()
+        with self.assertNumQueries(1):
+            histogram = get_price_histogram({})
+        self.assertEqual(histogram, [
+            {'min': 10, 'max': 20, 'count': 1},
+            {'min': 20, 'max': 30, 'count': 1},
+            {'min': 30, 'max': 40, 'count': 2},
+        ])
+        # the histogram ignores its own price range, but applies the other filters
+        self.assertEqual(get_price_histogram({'price_min': '30', 'category': 'toys'}), [
+            {'min': 10, 'max': 20, 'count': 1},
+            {'min': 20, 'max': 30, 'count': 1},
+        ])
+
+    def test_price_histogram_is_cached(self):
+        get_price_histogram({'category': 'toys'})
+        with self.assertNumQueries(0):
+            get_price_histogram({'category': ['toys']})
+        Product.objects.create(name="Product 4", category=self.toys, price=15.00)
+        self.assertEqual(get_price_histogram({'category': 'toys'})[0]['count'], 2)
+
+    def test_view_list_renders_counts_and_hides_dead_options(self):
+        response = self.client.get(reverse('products:home'), {'category': 'wear'})
+        self.assertNotContains(response, 'value="silicone"')
+        self.assertContains(response, 'value="leather"')
+        self.assertContains(response, 'value="toys"')
+
+
+class TaxonomyRegistryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.toys = Category.objects.create(name="Toys")
+        self.leather = Material.objects.create(name="Leather")
+        self.product = Product.objects.create(name="Product 1", category=self.toys, material=self.leather, price=10.00)
+
+    def test_taxonomy_is_loaded_once(self):
+        get_taxonomy()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_taxonomy().get_options('category'), [self.toys])
+            self.assertEqual(get_taxonomy().get_option('material', 'leather'), self.leather)
+            self.assertIsNone(get_taxonomy().get_option('material', 'silicone'))
+
+    def test_changes_reload_the_registry(self):
+        get_taxonomy()
+        self.toys.name = "Play things"
+        self.toys.save()
+        self.assertEqual(get_taxonomy().get_option('category', 'play-things'), self.toys)
+        self.assertIsNone(get_taxonomy().get_option('category', 'toys'))
+        self.leather.delete()
+        self.assertEqual(get_taxonomy().get_options('material'), [])
+
+    def test_changes_in_other_processes_reload_the_registry(self):
+        get_taxonomy()
+        # simulate another process: the row changes without this process' signals, but the shared version is bumped
+        Category.objects.filter(pk=self.toys.pk).update(slug='games')
+        self.assertIsNotNone(get_taxonomy().get_option('category', 'toys'))
+        cache.delete('a_products:taxonomy_version')
+        self.assertIsNotNone(get_taxonomy().get_option('category', 'games'))
+
+    def test_version_bumps_reach_other_processes(self):
+        # the versions have to live in a cache shared between processes, not in a per-process LocMemCache
+        get_taxonomy()
+        Category.objects.filter(pk=self.toys.pk).update(slug='games')
+        script = 'from a_products.taxonomy import bump_taxonomy_version; bump_taxonomy_version()'
+        # point the other process at the test run's cache (see a_core/test_runner.py), not the configured one
+        env = {**os.environ, 'CACHE_URL': f"filecache://{settings.CACHES['default']['LOCATION']}"}
+        subprocess.run([sys.executable, 'manage.py', 'shell', '-c', script], cwd=settings.BASE_DIR, env=env, check=True)
+        self.assertIsNotNone(get_taxonomy().get_option('category', 'games'))
+
+    def test_filter_by_params_drops_unknown_slugs(self):
+        self.assertEqual(list(Product.objects.filter_by_params(category=['toys', 'unknown'])), [self.product])
+        get_taxonomy()
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Product.objects.filter_by_params(category='unknown', material='leather')), [])
+
+
+@override_settings(PRODUCT_BITMAP_INDEX=True)
+class BitmapIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        product_index.is_built = False
+        self.toys = Category.objects.create(name="Toys")
+        self.wear = Category.objects.create(name="Wear")
+        self.leather = Material.objects.create(name="Leather")
+        self.play = Purpose.objects.create(name="Play")
+        self.style = Purpose.objects.create(name="Style")
+        self.hands = BodyPart.objects.create(name="Hands")
+        self.product1 = Product.objects.create(name="Product 1", category=self.toys, material=self.leather, price=10.00)
+        self.product2 = Product.objects.create(name="Product 2", category=self.toys, price=20.00)
+        self.product3 = Product.objects.create(name="Product 3", category=self.wear, material=self.leather, price=30.00)
+        self.product1.purpose.add(self.play, self.style)
+        self.product3.purpose.add(self.style)
+        self.product3.body_parts.add(self.hands)
+
+    def tearDown(self):
+        product_index.is_built = False
+
+    def assertMatches(self, params, expected):
+        self.assertEqual(set(Product.objects.filter_by_params(**params)), set(expected))
+        with self.settings(PRODUCT_BITMAP_INDEX=False):
+            self.assertEqual(set(Product.objects.filter_by_params(**params)), set(expected))
+
+    def test_bitset_conversion(self):
+        self.assertEqual(bitset_to_ids(ids_to_bitset([3, 0, 17, 64])), [0, 3, 17, 64])
+        self.assertEqual(ids_to_bitset([]), 0)
+
+    def test_filter_matches_sql_path(self):
+        self.assertMatches({'category': 'toys'}, [self.product1, self.product2])
+        self.assertMatches({'category': ['toys', 'wear'], 'material': 'leather'}, [self.product1, self.product3])
+        self.assertMatches({'purpose': ['play', 'style']}, [self.product1, self.product3])
+        self.assertMatches({'purpose': 'style', 'body_part': 'hands'}, [self.product3])
+        self.assertMatches({'category': 'unknown'}, [])
+        self.assertMatches({'category': 'toys', 'price_min': '15'}, [self.product2])
+
+    def test_filter_is_a_single_query(self):
+        Product.objects.filter_by_params(category='toys').count()  # build the index
+        with self.assertNumQueries(1):
+            list(Product.objects.filter_by_params(category='toys', purpose=['play', 'style']))
+
+    def test_filter_passes_large_id_sets_as_one_parameter(self):
+        with mock.patch.object(connection.features, 'max_query_params', 1):
+            self.assertMatches({'category': 'toys'}, [self.product1, self.product2])
+
+    def test_index_follows_product_changes(self):
+        Product.objects.filter_by_params(category='toys').count()  # build the index
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product2.category = self.wear
+            self.product2.save()
+            self.product1.purpose.remove(self.style)
+            self.style.product_set.add(self.product2)
+            self.product3.delete()
+            product4 = Product.objects.create(name="Product 4", category=self.toys, price=40.00)
+        self.assertTrue(product_index.is_built)
+        self.assertEqual(product_index.version, cache.get('a_products:catalog_version'))
+        self.assertMatches({'category': 'toys'}, [self.product1, product4])
+        self.assertMatches({'purpose': 'style'}, [self.product2])
+
+    def test_index_follows_taxonomy_changes(self):
+        Product.objects.filter_by_params(category='toys').count()  # build the index
+        with self.captureOnCommitCallbacks(execute=True):
+            self.toys.name = "Playthings"
+            self.toys.save()
+            self.play.product_set.clear()
+            self.leather.delete()
+        self.assertTrue(product_index.is_built)
+        self.assertEqual(product_index.version, cache.get('a_products:catalog_version'))
+        self.assertMatches({'category': 'playthings'}, [self.product1, self.product2])
+        self.assertMatches({'category': 'toys'}, [])
+        self.assertMatches({'purpose': 'play'}, [])
+        self.assertMatches({'material': 'leather'}, [])
+
+    def test_index_rebuilds_after_changes_from_other_processes_before_commit(self):
+        Product.objects.filter_by_params(category='toys').count()  # build the index
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product2.category = self.wear
+            self.product2.save()
+            # another process changes the catalog while this transaction is still open
+            Product.objects.filter(pk=self.product1.pk).update(category=self.wear)
+            cache.set('a_products:catalog_version', 'changed-elsewhere')
+        self.assertNotEqual(product_index.version, cache.get('a_products:catalog_version'))
+        self.assertMatches({'category': 'wear'}, [self.product1, self.product2, self.product3])
+
+    def test_index_ignores_rolled_back_changes(self):
+        Product.objects.filter_by_params(category='toys').count()  # build the index
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.product2.category = self.wear
+                self.product2.save()
+                self.play.product_set.clear()
+                raise RuntimeError("failed save")
+        self.assertNotEqual(product_index.version, cache.get('a_products:catalog_version'))
+        self.assertMatches({'category': 'toys'}, [self.product1, self.product2])
+        self.assertMatches({'purpose': 'play'}, [self.product1])
+
+    def test_index_rebuilds_after_changes_from_other_processes(self):
+        Product.objects.filter_by_params(category='toys').count()  # build the index
+        # simulate another process changing the catalog: the version changes without local signals
+        cache.set('a_products:catalog_version', 'changed-elsewhere')
+        Product.objects.filter(pk=self.product2.pk).update(category=self.wear)
+        self.assertMatches({'category': 'wear'}, [self.product2, self.product3])
+
+    def test_facet_counts_from_index(self):
+        self.assertEqual(get_facet_counts({'category': 'toys'})['purpose'], {'play': 1, 'style': 1})
+        self.assertEqual(get_facet_counts({})['category'], {'toys': 2, 'wear': 1})
+        self.assertEqual(get_facet_counts({'q': 'product 3'})['category'], {'wear': 1})
+        self.assertEqual(get_facet_counts({'price_min': '15'})['category'], {'toys': 1, 'wear': 1})
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.toys = Category.objects.create(name="Toys")
+        self.wear = Category.objects.create(name="Wear")
+        self.harness = Product.objects.create(name="Leather harness", description="Adjustable straps", category=self.wear, price=50.00)
+        self.paddle = Product.objects.create(name="Paddle", description="Made of smooth leather", category=self.toys, price=25.00)
+        self.plug = Product.objects.create(name="Silicone plug", description="Body-safe silicone", category=self.toys, price=15.00)
+
+    def test_search_ranks_name_matches_first(self):
+        self.assertEqual(list(Product.objects.search("leather")), [self.harness, self.paddle])
+
+    def test_search_matches_all_words_as_prefixes(self):
+        self.assertEqual(list(Product.objects.search("sili PLUG")), [self.plug])
+        self.assertEqual(list(Product.objects.search("silicone leather")), [])
+
+    def test_search_ignores_fts_syntax_in_user_input(self):
+        self.assertEqual(list(Product.objects.search('"leather* (')), [self.harness, self.paddle])
+        self.assertEqual(Product.objects.search("  *  ").count(), 3)
+
+    def test_search_is_driven_by_the_full_text_index(self):
+        plan = Product.objects.filter_by_params(q="leather", category="toys").explain()
+        self.assertIn('SCAN a_products_product_fts VIRTUAL TABLE', plan)
+        self.assertIn('SEARCH a_products_product USING INTEGER PRIMARY KEY', plan)
+        self.assertNotIn('CORRELATED', plan)
+
+    def test_search_combines_with_facet_filters(self):
+        self.assertEqual(list(Product.objects.filter_by_params(q="leather", category="toys")), [self.paddle])
+
+    def test_index_follows_product_changes(self):
+        self.harness.name = "Rope harness"
+        self.harness.description = "Soft cotton rope"
+        self.harness.save()
+        self.paddle.delete()
+        Product.objects.create(name="Leather cuffs", price=30.00)
+        self.assertEqual([p.name for p in Product.objects.search("leather")], ["Leather cuffs"])
+        self.assertEqual(list(Product.objects.search("cotton")), [self.harness])
+
+    def test_rebuild_command(self):
+        Product.objects.filter(pk=self.plug.pk).update(description="Bulk updated description")
+        call_command('rebuild_search_index', stdout=mock.Mock())
+        self.assertEqual(list(Product.objects.search("bulk")), [self.plug])
+        self.assertEqual(list(Product.objects.search("body")), [])
+
+    def test_facet_counts_with_search(self):
+        counts = get_facet_counts({'q': 'leather'})
+        self.assertEqual(counts['category'], {'toys': 1, 'wear': 1})
+
+    def test_view_list_with_search(self):
+        response = self.client.get(reverse('products:home'), {'q': 'silicone'}, HTTP_HX_REQUEST='true')
+        self.assertContains(response, "Silicone plug")
+        self.assertNotContains(response, "Paddle")
+
+    def test_view_list_with_search_without_words(self):
+        response = self.client.get(reverse('products:home'), {'q': '!!!'}, HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Paddle")
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name="Test Category")
+        # a few duplicate prices, to check that the id tie-breaker keeps pages stable
+        self.products = [
+            Product.objects.create(name=f"Product {i}", description="Soft leather" if i % 2 else "Cotton", category=self.category, price=10 + i % 4)
+            for i in range(30)
+        ]
+
+    def collect_pages(self, queryset, ordering, page_size):
+        items, cursor = get_page(queryset, ordering, page_size=page_size)
+        pages = [items]
+        while cursor:
+            items, cursor = get_page(queryset, ordering, cursor, page_size=page_size)
+            pages.append(items)
+        return pages
+
+    def test_pages_cover_all_products_once(self):
+        for ordering in [('id',), ('price', 'id'), ('-price', '-id'), ('-created_at', '-id')]:
+            with self.subTest(ordering=ordering):
+                pages = self.collect_pages(Product.objects.all(), ordering, page_size=7)
+                self.assertEqual([len(page) for page in pages], [7, 7, 7, 7, 2])
+                items = [item for page in pages for item in page]
+                self.assertEqual(items, list(Product.objects.order_by(*ordering)))
+
+    def test_search_results_are_paginated_by_rank(self):
+        queryset = Product.objects.search("leather")
+        items = [item for page in self.collect_pages(queryset, ('search_rank', 'id'), page_size=4) for item in page]
+        self.assertEqual(items, list(queryset))
+        self.assertEqual(len(items), 15)
+
+    def test_page_query_uses_keyset_instead_of_offset(self):
+        items, cursor = get_page(Product.objects.all(), ('price', 'id'), page_size=5)
+        with CaptureQueriesContext(connection) as queries:
+            get_page(Product.objects.all(), ('price', 'id'), cursor, page_size=5)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+        self.assertIn('LIMIT 6', queries[0]['sql'])
+
+    def test_invalid_cursor_starts_at_first_page(self):
+        items, cursor = get_page(Product.objects.all(), ('id',), 'tampered', page_size=5)
+        self.assertEqual(items, self.products[:5])
+
+    def test_cursor_for_another_ordering_starts_at_first_page(self):
+        items, cursor = get_page(Product.objects.all(), ('price', 'id'), page_size=5)
+        items, next_cursor = get_page(Product.objects.all(), ('-created_at', '-id'), cursor, page_size=5)
+        self.assertEqual(items, list(Product.objects.order_by('-created_at', '-id')[:5]))
+
+        response = self.client.get(reverse('products:home'), {'sort': 'newest', 'cursor': cursor}, HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 200)
+
+    def test_view_list_load_more(self):
+        response = self.client.get(reverse('products:home'), HTTP_HX_REQUEST='true')
+        self.assertContains(response, 'id="load-more"')
+        next_url = response.context['next_page_query']
+        self.assertIn('cursor=', next_url)
+
+        response = self.client.get(f"{reverse('products:home')}?{next_url}", HTTP_HX_REQUEST='true')
+        self.assertTemplateUsed(response, 'products/partials/product_page.html')
+        self.assertEqual(response.context['products'], self.products[24:])
+        self.assertNotContains(response, 'id="product-list"')
+        self.assertNotContains(response, 'id="load-more"')
+
+class ProductSortTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.toys = Category.objects.create(name="Toys")
+        self.books = Category.objects.create(name="Books")
+        self.products = [
+            Product.objects.create(name=f"Product {59 - i:02d}", category=self.toys if i % 2 else self.books, price=10 + i % 5)
+            for i in range(60)
+        ]
+
+    def test_sort_options_with_filters_and_pages(self):
+        for sort, ordering in SORT_OPTIONS.items():
+            with self.subTest(sort=sort):
+                response = self.client.get(reverse('products:home'), {'sort': sort, 'category': 'toys'}, HTTP_HX_REQUEST='true')
+                items = list(response.context['products'])
+                response = self.client.get(f"{reverse('products:home')}?{response.context['next_page_query']}", HTTP_HX_REQUEST='true')
+                items += response.context['products']
+                self.assertEqual(len(items), 30)
+                self.assertEqual(items, list(Product.objects.filter(category=self.toys).order_by(*ordering)))
+
+    def test_unknown_sort_falls_back_to_default(self):
+        response = self.client.get(reverse('products:home'), {'sort': 'nonsense'}, HTTP_HX_REQUEST='true')
+        self.assertEqual(list(response.context['products']), self.products[:24])
+
+    def test_sorted_pages_use_index_order(self):
+        # the composite indexes let SQLite read the rows in sort order, without a sort step
+        for sort, ordering in SORT_OPTIONS.items():
+            for params in [{}, {'category': 'toys'}]:
+                with self.subTest(sort=sort, params=params):
+                    queryset = Product.objects.filter_by_params(**params).order_by(*ordering)
+                    last = queryset[4]
+                    plan = after_keyset(queryset, ordering, [getattr(last, key.lstrip('-')) for key in ordering]).explain()
+                    self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_deep_pages_seek_the_index(self):
+        # the cost of a page must not grow with its depth: the index is searched from the cursor, not scanned from the start
+        for sort, ordering in SORT_OPTIONS.items():
+            with self.subTest(sort=sort):
+                queryset = Product.objects.order_by(*ordering)
+                last = queryset[50]
+                plan = after_keyset(queryset, ordering, [getattr(last, key.lstrip('-')) for key in ordering]).explain()
+                self.assertRegex(plan, r'SEARCH .*USING INDEX product_\w+_idx \(\w+[<>]\?\)')
+
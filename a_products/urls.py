@@ -15,7 +15,7 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 from . import views
 
 app_name = 'products'
@@ -23,4 +23,5 @@ app_name = 'products'
 urlpatterns = [
     path('', views.view_list, name='home'),
     path('products/<slug:slug>/', views.view_product, name='view_product'),
+    re_path(r'^feeds/products\.(?P<file_format>csv|xml)(?P<compressed>\.gz)?$', views.view_feed, name='feed'),
 ]
@@ -1,4 +1,9 @@
 from urllib.parse import urlencode
+from django.core.cache import cache
+import hashlib
+import uuid
+
+CATALOG_VERSION_KEY = 'a_products:catalog_version'
 
 def clean_filter_url(request):
     cleaned_params = {}
@@ -34,3 +39,46 @@ def get_search_params(request, valid_params):
         if request.GET.get(param)
     }
 
+def normalize_filter_params(params, valid_params):
+    """
+    Normalize filter parameters so that equivalent filter sets compare (and cache) equal.
+
+    :param params: A QueryDict (e.g. request.GET) or a dictionary of single values or lists
+    :param valid_params: The parameter names to keep
+    :return: A dictionary of parameter name to a sorted tuple of unique, non-empty values
+    """
+    items = params.lists() if hasattr(params, 'lists') else params.items()
+    normalized = {}
+    for key, values in items:
+        if key not in valid_params:
+            continue
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        clean_values = tuple(sorted({str(v) for v in values if v}))
+        if clean_values:
+            normalized[key] = clean_values
+    return dict(sorted(normalized.items()))
+
+def get_params_cache_key(prefix, params):
+    """
+    Build a cache key for normalized parameters, scoped to the current catalog version.
+    """
+    digest = hashlib.md5(urlencode(params, doseq=True).encode()).hexdigest()
+    return f"{prefix}:{get_catalog_version()}:{digest}"
+
+def get_catalog_version():
+    """
+    Return a token that changes whenever products, their images or the taxonomy change.
+
+    The token lives in the cache shared by all processes (see the CACHES setting), so a change saved
+    by one worker or management command invalidates the in-process state of every other one.
+    """
+    return cache.get_or_set(CATALOG_VERSION_KEY, lambda: uuid.uuid4().hex, timeout=None)
+
+def bump_catalog_version():
+    """
+    :return: The new catalog version
+    """
+    version = uuid.uuid4().hex
+    cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+    return version
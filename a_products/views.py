@@ -1,38 +1,84 @@
 from django.shortcuts import render
+from django.http import Http404, StreamingHttpResponse
 from django.contrib.auth.models import AnonymousUser
-from .models import Product, Category, Purpose, Material, BodyPart
-from a_cart.models import Cart
+from django.views.decorators.http import condition, require_safe
+from .models import SORT_OPTIONS
+from .facets import filter_with_facets, get_facet_options, get_price_histogram, get_price_options
+from .pagination import get_page
+from .cards import render_product_cards
+from .slugs import resolve_product
+from .feeds import FEED_FORMATS, generate_feed
+from .conditional import catalog_page, get_catalog_state
 import logging
 import time
 
 logger = logging.getLogger(__name__)
 
+@catalog_page
 def view_list(request):
-    # use custom 'filter_by_params' to filter the products on request.GET search parameters
-    products = Product.objects.filter_by_params(**request.GET)
-    cart, created = Cart.get_or_create_from_request(request)
- 
+    # filter the products on the request.GET search parameters and count the matches per filter option
+    products, facet_counts, params = filter_with_facets(request.GET)
+    ordering = get_ordering(request.GET.get('sort'), products)
+    cursor = request.GET.get('cursor')
+    products, next_cursor = get_page(products.with_card_images(), ordering, cursor)
 
-    context = {'products': products, 'cart': cart}
+    context = {'products': products, 'cards': render_product_cards(products), 'next_page_query': get_next_page_query(request, next_cursor)}
     
     time.sleep(1)
 
+    # 'load more' requests only need the next page of product cards
+    if cursor:
+        return render(request, 'products/partials/product_page.html', context)
+
+    context['facets'] = get_facet_options(params, facet_counts)
+    context['price'] = get_price_options(params, get_price_histogram(params))
     if request.htmx:
-        return render(request, 'cotton/product_list.html', context)
+        return render(request, 'products/partials/product_list.html', context)
     
-    # if it's not an HTMX request, we also have to get the categories, materials etc to render the whole page
-    context.update({
-            'categories': Category.objects.all(),
-            'purposes': Purpose.objects.all(),
-            'materials': Material.objects.all(),
-            'body_parts': BodyPart.objects.all(),
-        })
     return render(request, 'products/product_list.html', context)
 
+def get_ordering(sort, products):
+    # an explicit sort option wins; otherwise full-text searches are sorted by relevance
+    # (a query without words, or the LIKE fallback without FTS5, has no `search_rank` to sort on)
+    if sort in SORT_OPTIONS:
+        return SORT_OPTIONS[sort]
+    return ('search_rank', 'id') if 'search_rank' in products.query.extra_select else ('id',)
+
+def get_next_page_query(request, next_cursor):
+    if not next_cursor:
+        return None
+    query = request.GET.copy()
+    query['cursor'] = next_cursor
+    return query.urlencode()
+
+@catalog_page
 def view_product(request, slug):
-    product = Product.objects.get(slug=slug)
+    product = resolve_product(slug)
+    if product is None:
+        raise Http404("No product found with this slug")
     context = {'product': product}
 
     if request.htmx:
         return render(request, 'products/product_detail_content.html', context)    
-    return render(request, 'products/product_detail.html', context)
\ No newline at end of file
+    return render(request, 'products/product_detail.html', context)
+
+
+def get_feed_etag(request, file_format, compressed=None):
+    token, last_modified = get_catalog_state(request)
+    return f"{token}-{file_format}{'-gz' if compressed else ''}"
+
+def get_feed_last_modified(request, file_format, compressed=None):
+    return get_catalog_state(request)[1]
+
+@require_safe
+@condition(etag_func=get_feed_etag, last_modified_func=get_feed_last_modified)
+def view_feed(request, file_format, compressed=None):
+    """
+    Stream the product feed as CSV or XML ('.gz' compressed); an unchanged feed is answered with a 304.
+    """
+    base_url = request.build_absolute_uri('/').rstrip('/')
+    response = StreamingHttpResponse(generate_feed(file_format, base_url, compress=bool(compressed)))
+    filename = f'products.{file_format}{compressed or ""}'
+    response['Content-Type'] = 'application/gzip' if compressed else FEED_FORMATS[file_format]
+    response['Content-Disposition'] = f'inline; filename="{filename}"'
+    return response
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 14:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_profiles', '0002_alter_profile_avatar'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='avatar_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
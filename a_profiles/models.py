@@ -2,11 +2,14 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.templatetags.static import static
+from a_core.images import get_picture_sources
 
 # Profile class with one-to-one relationship to User model, with avatar image, name, address, phone number, email, and bio
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    # resized copies of the avatar in modern formats, generated after upload (see a_core.images)
+    avatar_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     name = models.CharField(max_length=100, null=True, blank=True)
     address = models.CharField(max_length=100, null=True, blank=True)
     phone_number = models.CharField(max_length=15, null=True, blank=True)
@@ -23,5 +26,8 @@ class Profile(models.Model):
             return self.avatar.url
         return static('images/default-avatar.jpg')
 
+    def get_avatar_sources(self):
+        return get_picture_sources(self.avatar, self.avatar_derivatives)
+
     
     
\ No newline at end of file
@@ -1,6 +1,7 @@
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
+from a_core.images import needs_derivatives, schedule_derivatives
 from .models import Profile
 
 @receiver(post_save, sender=User)
@@ -25,3 +26,8 @@ def update_user_email(sender, instance, created, **kwargs):
 def delete_profile(sender, instance, **kwargs):
     Profile.objects.filter(user=instance).delete()
 
+# signal that generates resized copies of a new avatar, off the request path (see a_core.images)
+@receiver(post_save, sender=Profile)
+def generate_avatar_derivatives(sender, instance, raw=False, **kwargs):
+    if not raw and needs_derivatives(instance.avatar, instance.avatar_derivatives):
+        schedule_derivatives(instance, 'avatar', 'avatar_derivatives')
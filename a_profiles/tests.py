@@ -1,4 +1,8 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
+import io
+import tempfile
 from django.contrib.auth.models import User
 from django.urls import reverse
 from .models import Profile
@@ -128,9 +132,28 @@ class UserProfileTests(TestCase):
         self.client.logout()
         response = self.client.get(reverse('products:home'))
         self.assertEqual(response.status_code, 200)
+        # the page loads the cart menu of the navbar separately
+        response = self.client.get(reverse('cart:navbar_menus'))
 
-        # Check if a new cart is created after logout that's empty
-        cart_id = self.client.session['cart_id']
-        cart = Cart.objects.get(id=cart_id)
-        self.assertIsNotNone(cart)
-        self.assertEqual(cart.items.count(), 0)
\ No newline at end of file
+        # Check that the cart is empty after logout (it's only created once a product is added)
+        self.assertNotIn('cart_id', self.client.session)
+        self.assertContains(response, '0 Items')
+
+
+@override_settings(IMAGE_DERIVATIVE_WORKERS=0, IMAGE_DERIVATIVE_WIDTHS=[32, 64], IMAGE_DERIVATIVE_FORMATS=['webp'])
+class AvatarDerivativeTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root.name))
+        self.addCleanup(self.media_root.cleanup)
+
+    def test_avatar_derivatives(self):
+        user = User.objects.create_user(username='testuser', email='test@example.com', password='testpass123')
+        buffer = io.BytesIO()
+        Image.new('RGB', (128, 128), 'blue').save(buffer, 'PNG')
+        with self.captureOnCommitCallbacks(execute=True):
+            user.profile.avatar = SimpleUploadedFile('avatar.png', buffer.getvalue(), content_type='image/png')
+            user.profile.save()
+        user.profile.refresh_from_db()
+        self.assertEqual([d['width'] for d in user.profile.avatar_derivatives['formats']['webp']], [32, 64])
+        self.assertEqual(user.profile.get_avatar_sources()[0]['type'], 'image/webp')